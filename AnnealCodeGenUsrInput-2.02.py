@@ -8,6 +8,11 @@ between each temperature change but it is not visible.
 Only solution I see is to overload the G4 command so that it can take a 
 text string to display. I guess this could be my addition to Marlin.
 
+Version 2.03
+Gcode generation moved into the importable ikneel package, generate_anneal()
+Non-interactive command line for job files:  python -m ikneel generate --jobs FILE
+This script keeps the banner and prompts and calls the package
+
 Version 2.02
 User inputs expanded to include
 	Name
@@ -30,7 +35,11 @@ v. 2.0. If a copy of the MPL was not distributed with this file,
 You can obtain one at https://mozilla.org/MPL/2.0/.
 
 """
- 
+
+# The gcode itself is written by the ikneel package next to this file, which
+# can also be imported or run without prompts:  python -m ikneel --help
+from ikneel import LIMITS, file_name, write_anneal
+
 # Define function used to get & check user input
 def userInput( message, minimum, maximum):
    while True:
@@ -79,74 +88,19 @@ print(" ")
 
 # Get user input
 MaterialName = input('Enter the target material (used for file name):  ')
-AnnealTemp = userInput( 'Enter annealing temperature, deg C (50-120):  ', 50, 120)
-HeatRate = userInput( 'Enter heating rate, deg C per hour, 11 to 28:  ', 11, 28)
-SoakTime = userInput( 'Enter the soak time before starting ramp down, minutes [6 to 999]:  ', 6, 999)
-CoolRate = userInput( 'Enter the cooling rate, deg C per hour, (6 - 28):  ', 6, 28)
-# was 21, need to think about this
-Ambient = 27
+AnnealTemp = userInput( 'Enter annealing temperature, deg C (50-120):  ', *LIMITS['anneal_temp'])
+HeatRate = userInput( 'Enter heating rate, deg C per hour, 11 to 28:  ', *LIMITS['heat_rate'])
+SoakTime = userInput( 'Enter the soak time before starting ramp down, minutes [6 to 999]:  ', *LIMITS['soak_time'])
+CoolRate = userInput( 'Enter the cooling rate, deg C per hour, (6 - 28):  ', *LIMITS['cool_rate'])
+# Ambient is ikneel.AMBIENT, 27 deg C
 # future thoughts, could read bed temp and assume it is at ambient
 # Can gcode do math & code? I don't think so
 
-# Compute times based on user input
-# How long in seconds between changes in target temperature
-DwellHeat = 3600 / HeatRate
-DwellCool = 3600 / CoolRate
-# How long will it take to ramp up to and down to at the specified rate, minutes
-HeatTime = (AnnealTemp - Ambient) / HeatRate * 60
-CoolTime = (AnnealTemp - Ambient) / CoolRate * 60
-
 #build the file name
-fileName = MaterialName + '_anneal_' + str(AnnealTemp) + '_' + str(HeatRate) + '_' + str(SoakTime) + '_' + str(CoolRate)
+fileName = file_name(MaterialName, AnnealTemp, HeatRate, SoakTime, CoolRate)
 
 # Open a file & fill with gcode to anneal parts
-fo = open(fileName + ".gcode", "w")
-
-# Write file header
-fo.write('; gcode to control heat bed to anneal printed parts\n')
-fo.write('; Material is: ' + MaterialName + '\n')
-fo.write('; Annealing holding temperature is: ' + str(AnnealTemp) + ' deg C\n')
-fo.write('; Heating will take: ' + str(HeatTime) + ' minutes (' + str(HeatTime/60) + ' hours)\n')
-fo.write('; Heating rate is: ' + str(HeatRate) + ' deg C per hour\n')
-fo.write('; Hold at annealing temperature for: ' + str(SoakTime) + 'minutes\n')
-fo.write('; Cooling rate is: ' + str(CoolRate) + ' deg C per hour\n')
-fo.write('; Cooling will take: ' + str(CoolTime) + ' minutes (' + str(CoolTime/60) + ' hours)\n')
-fo.write('; Ambient temperature is assumed to be 21 deg C (70 deg F)\n')
-fo.write('; \n')
-
-# Disable motors, they are not needed and make sure extruder is off
-fo.write('M84 ; Make sure motors are OFF\n')
-fo.write('M104 S0 ; Make sure extruder is OFF\n')
-fo.write('; \n')
-
-# Ramp the temp up as specified
-fo.write('M117 Ramping temp up\n')
-for num in range(Ambient, AnnealTemp + 1):
-    fo.write('M140 S' + str(num) + ' ; Raise bed temp to next higher to ramp smoothly\n')
-    fo.write('G4 S' + str(int(DwellHeat)) + ' ; and pause x seconds to meet defined rate\n')	# Displays Sleep.... during this time!
-    #fo.write('G4 S' + str(int(DwellHeat)) + str(int(HeatTime - (DwellHeat / 60))) + '\n')	# New call for modified G4 command, if used comment next 2 lines
-    HeatTime = HeatTime - (DwellHeat / 60)   # Subtract the dwell time from the total time to use as count down timer
-    fo.write('M117 Heating ' + str(int(HeatTime)) + ' more min\n')	# Finding that this display does not happen until AFTER the sleep time
-
-# Hold at temperature for set time. Count down the minutes via display
-for num in range(SoakTime, 0, -1):
-    fo.write('G4 S60\n')
-    SoakTime = SoakTime - 1
-    fo.write('M117 Soak ' + str(SoakTime) + ' more min\n')
-    
-# Ramp the temp down as specifed
-fo.write('M117 Ramping temp down\n')
-for num in range(AnnealTemp, Ambient, -1):
-    fo.write('M140 S' + str(num) + '\n')
-    fo.write('G4 S' + str(int(DwellCool)) + '\n')
-    CoolTime = CoolTime - int(DwellCool / 60)
-    fo.write('M117 Cooling ' + str(int(CoolTime)) + ' more min\n')
-
-# Turn off bed heater
-fo.write('M140 S0  ; Turn OFF bed heater\n')
-fo.write('M117 Done!\n')
-
-fo.close()
+write_anneal(fileName + ".gcode", MaterialName, AnnealTemp, HeatRate, SoakTime, CoolRate)
 
 print(' ')
 print(fileName + ".gcode written to disk.")
@@ -0,0 +1,11 @@
+"""
+iKneel - generate gcode to use a 3D printers heat bed as an annealing oven.
+
+    from ikneel import generate_anneal
+    program = generate_anneal('PLA', 80, 20, 60, 10)
+"""
+
+from .gcode import (AMBIENT, LIMITS, check_params, file_name, generate_anneal,
+                    iter_anneal, stream_anneal, write_anneal)
+
+__version__ = '2.03'
@@ -0,0 +1,255 @@
+"""
+Check anneal programs before running them.
+
+analyze() reads a .gcode file (memory mapped) or .gcode.gz in one pass
+over its M140 and G4 lines and rebuilds the bed setpoint against time. From
+that it measures what the program will actually do:
+
+duration   seconds of G4 in all
+heat_rate  deg C per hour from the first setpoint to the peak
+hold       seconds the setpoint stays at the peak
+cool_rate  deg C per hour from leaving the peak to the last setpoint
+max_jump   the largest change between one setpoint and the next
+
+and flags anything that disagrees with the comments iKneel writes at the
+top of a program, or that looks unsafe: no dwells, a setpoint above the
+highest anneal temperature, the bed left on at the end.
+
+analyze_many() does whole directories, over a process pool if asked.
+"""
+
+import gzip
+import mmap
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .gcode import LIMITS
+
+# Relative difference from the header allowed before a value is flagged
+TOLERANCE = 0.02
+# Largest setpoint change between steps not flagged, deg C
+MAX_JUMP = 5
+# The header is in the first few lines; this is plenty
+HEADER_BYTES = 4096
+
+# M140 S<setpoint> or G4 S<seconds> / P<milliseconds>, taking the number
+# straight from the match since nearly every line is one of these
+COMMAND = re.compile(rb'^[ \t]*(?:N\d+[ \t]+)?(?:M140[ \t]+S[ \t]*(-?[\d.]+)'
+                     rb'|G4[ \t]+([SP])[ \t]*(-?[\d.]+))', re.M)
+# A program picked up part way through (resume.py) or of several stages
+# (profile.py), whose header the three phase checks do not fit
+RESUMED = re.compile(rb'^; Resumed ', re.M)
+PROFILE = re.compile(rb'^; Profile of ', re.M)
+# Loops run by RepRapFirmware or Klipper, see firmware.py
+LOOP = re.compile(rb'^[ \t]*(?:while\b|ANNEAL_RAMP\b|ANNEAL_HOLD\b)', re.M)
+HEADER = {
+    'anneal_temp': re.compile(rb'^; Annealing holding temperature is: (\d+)', re.M),
+    'heat_minutes': re.compile(rb'^; Heating will take: ([\d.]+) minutes', re.M),
+    'heat_rate': re.compile(rb'^; Heating rate is: (\d+)', re.M),
+    'soak_time': re.compile(rb'^; Hold at annealing temperature for: (\d+)', re.M),
+    'cool_rate': re.compile(rb'^; Cooling rate is: (\d+)', re.M),
+    'cool_minutes': re.compile(rb'^; Cooling will take: ([\d.]+) minutes', re.M),
+}
+
+# header is the dict of values read from the comments, empty if there were
+# none. profile is a list of (seconds, setpoint), one per M140. Rates are
+# None when a ramp has fewer than two setpoints; flags lists the problems.
+Analysis = namedtuple('Analysis', 'path size duration peak heat_rate hold cool_rate'
+                                  ' max_jump header profile flags')
+
+
+def read_header(data):
+    header = {}
+    for name, pattern in HEADER.items():
+        match = pattern.search(data, 0, HEADER_BYTES)
+        if match:
+            header[name] = float(match.group(1))
+    if LOOP.search(data, 0, HEADER_BYTES):
+        header['loops'] = True
+    if RESUMED.search(data, 0, HEADER_BYTES):
+        header['resumed'] = True
+    if PROFILE.search(data, 0, HEADER_BYTES):
+        header['profile'] = True
+    return header
+
+
+def scan(data):
+    """The (seconds, setpoint) of every M140 and the total G4 seconds"""
+    profile = []
+    now = 0.0
+    for setpoint, unit, dwell in COMMAND.findall(data):
+        if setpoint:
+            profile.append((now, float(setpoint)))
+        elif unit == b'S':
+            now += float(dwell)
+        else:
+            now += float(dwell) / 1000
+    return profile, now
+
+
+def ramp_rate(points):
+    """deg C per hour, up or down, between the first and last of (seconds, setpoint)"""
+    if len(points) < 2 or points[-1][0] == points[0][0]:
+        return None
+    return abs(points[-1][1] - points[0][1]) * 3600 / (points[-1][0] - points[0][0])
+
+
+def cycle_of(profile):
+    """The profile less the final M140 S0, which turns the bed off"""
+    return profile[:-1] if profile and profile[-1][1] == 0 else profile
+
+
+def find_peak(cycle):
+    """(peak, index of the first setpoint at it, index of the first below it after)"""
+    peak = max(setpoint for _, setpoint in cycle)
+    first = next(index for index, (_, setpoint) in enumerate(cycle) if setpoint == peak)
+    leave = next((index for index in range(first, len(cycle)) if cycle[index][1] < peak),
+                 len(cycle))
+    return peak, first, leave
+
+
+def peak_dwells(profile):
+    """Seconds of the ramp steps either side of the peak
+
+    The last heating step dwells at the peak, for as long as the step
+    before it took. When the cool ramp also starts with a step at the peak,
+    that is as long as the step after leaving it.
+    """
+    cycle = cycle_of(profile)
+    if not cycle:
+        return 0
+    _, first, leave = find_peak(cycle)
+    dwells = 0
+    if first > 0:
+        dwells += cycle[first][0] - cycle[first - 1][0]
+    if leave - 1 > first and leave + 1 < len(cycle):
+        dwells += cycle[leave + 1][0] - cycle[leave][0]
+    return dwells
+
+
+def measure_profile(profile, duration):
+    """peak, heat_rate, hold, cool_rate and max_jump of a setpoint profile"""
+    cycle = cycle_of(profile)
+    if not cycle:
+        return None, None, 0, None, 0
+    peak, first, leave = find_peak(cycle)
+    end = cycle[leave][0] if leave < len(cycle) else (
+        profile[-1][0] if len(profile) > len(cycle) else duration)
+    max_jump = max([abs(b[1] - a[1]) for a, b in zip(cycle, cycle[1:])] or [0])
+    return (peak, ramp_rate(cycle[:first + 1]), end - cycle[first][0],
+            ramp_rate(cycle[leave:]), max_jump)
+
+
+def off_by(value, expected, tolerance):
+    return value is None or abs(value - expected) > tolerance * expected
+
+
+def check(result, tolerance=TOLERANCE, max_jump=MAX_JUMP):
+    """Problems with an Analysis, as a list of strings"""
+    flags = []
+    if result.header.get('loops'):
+        return ['firmware loops; only unrolled Marlin programs can be checked']
+    if not result.duration:
+        flags.append('no G4 dwells')
+    if not result.profile:
+        return flags + ['no M140 setpoints']
+    if result.profile[-1][1] != 0:
+        flags.append('bed heater left on at the end')
+    if result.peak > LIMITS['anneal_temp'][1]:
+        flags.append('setpoint %g C is above %d C' % (result.peak, LIMITS['anneal_temp'][1]))
+    if result.max_jump > max_jump:
+        flags.append('setpoint jumps %g C in one step' % result.max_jump)
+    header = result.header
+    if not header:
+        return flags + ['no iKneel header to check against']
+    if header.get('resumed') or header.get('profile'):
+        # The header describes the whole cycle, not the part left, or
+        # stages rather than the heat / soak / cool values
+        return flags
+    if 'anneal_temp' in header and result.peak != header['anneal_temp']:
+        flags.append('peak %g C, header says %g C' % (result.peak, header['anneal_temp']))
+    for name, value in (('heat_rate', result.heat_rate), ('cool_rate', result.cool_rate)):
+        if name in header and off_by(value, header[name], tolerance):
+            flags.append('%s %s C/h, header says %g C/h' % (
+                name.replace('_', ' '), 'none' if value is None else '%.2f' % value,
+                header[name]))
+    if 'soak_time' in header:
+        # A stepped ramp sits at the peak for a step either side of the soak,
+        # however big the steps (--step, --commands)
+        soak = header['soak_time'] * 60
+        slack = peak_dwells(result.profile)
+        if not soak * (1 - tolerance) <= result.hold <= soak * (1 + tolerance) + slack:
+            flags.append('holds %.1f min at the peak, header soak is %g min'
+                         % (result.hold / 60, header['soak_time']))
+    if all(name in header for name in ('heat_minutes', 'soak_time', 'cool_minutes')):
+        expected = 60 * (header['heat_minutes'] + header['soak_time'] + header['cool_minutes'])
+        # Version 2.02 programs spend a step at ambient before the ramp starts
+        step = 3600.0 / header['heat_rate'] if 'heat_rate' in header else 0
+        if not expected * (1 - tolerance) <= result.duration <= expected * (1 + tolerance) + step:
+            flags.append('runs %.1f min, header adds up to %.1f min'
+                         % (result.duration / 60, expected / 60))
+    return flags
+
+
+def analyze(path, tolerance=TOLERANCE, max_jump=MAX_JUMP):
+    """Analysis of one .gcode or .gcode.gz file"""
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as fi:
+            data = fi.read()
+        return _analyze(path, data, len(data), tolerance, max_jump)
+    with open(path, 'rb') as fi:
+        size = os.fstat(fi.fileno()).st_size
+        if not size:
+            return _analyze(path, b'', 0, tolerance, max_jump)
+        with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _analyze(path, data, size, tolerance, max_jump)
+
+
+def _analyze(path, data, size, tolerance, max_jump):
+    header = read_header(data)
+    profile, duration = scan(data)
+    result = Analysis(path, size, duration, *measure_profile(profile, duration),
+                      header=header, profile=profile, flags=[])
+    return result._replace(flags=check(result, tolerance, max_jump))
+
+
+def find_programs(paths):
+    """Expand directories to the .gcode and .gcode.gz files under them, sorted"""
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            found.extend(os.path.join(root, name) for name in sorted(files)
+                         if name.endswith(('.gcode', '.gcode.gz')))
+    return found
+
+
+def _pool_analyze(item):
+    path, tolerance, max_jump = item
+    try:
+        return analyze(path, tolerance, max_jump)
+    except (OSError, ValueError) as err:
+        return Analysis(path, 0, 0, None, None, 0, None, 0, {}, [], ['cannot read: %s' % err])
+
+
+def analyze_many(paths, workers=1, tolerance=TOLERANCE, max_jump=MAX_JUMP):
+    """Yield an Analysis per file, directories expanded, in order
+
+    workers is as for batch.run_pool; a file that cannot be read is
+    flagged rather than stopping the run.
+    """
+    items = [(path, tolerance, max_jump) for path in find_programs(paths)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(items) <= 1:
+        for item in items:
+            yield _pool_analyze(item)
+    else:
+        chunksize = max(1, len(items) // (workers * 16))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(_pool_analyze, items, chunksize=chunksize):
+                yield result
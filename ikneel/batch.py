@@ -0,0 +1,210 @@
+"""
+Job files for generating many anneal programs in one run.
+
+A job file is either JSON, a list of objects, or CSV with a header row.
+Both use the parameter names of generate_anneal:
+
+    material,anneal_temp,heat_rate,soak_time,cool_rate,ambient
+    PLA,80,20,60,10,
+    PETG,120,20,150,10,25
+
+ambient is optional and defaults to gcode.AMBIENT. A preset column names
+a material preset (see presets.py) that fills in whatever the row leaves
+empty, material included:
+
+    preset,soak_time
+    PETG,
+    PLA,90
+
+Large job files can be spread over a process pool with run_pool(). Results
+still come back in job file order, and a bad row or a failed write is
+reported against its job instead of stopping the run.
+"""
+
+import csv
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from . import metrics
+from .gcode import AMBIENT, check_params, file_name, iter_anneal, write_anneal
+from .presets import store as preset_store
+from .writer import measure
+
+FIELDS = ('material', 'anneal_temp', 'heat_rate', 'soak_time', 'cool_rate', 'ambient')
+NUMBERS = ('anneal_temp', 'heat_rate', 'soak_time', 'cool_rate', 'ambient')
+WHOLE = re.compile(r'^\s*-?\d+\s*$')
+
+
+def whole_number(name, value):
+    """value as an int: an int already, or a string of digits as in CSV
+
+    Anything else, floats and booleans included, is a ValueError, as at
+    the prompts, rather than being truncated.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and WHOLE.match(value):
+        return int(value)
+    raise ValueError('%s must be a whole number, got %r' % (name, value))
+
+
+def make_job(row, presets=None):
+    """Turn one JSON object or CSV row into a checked job dict
+
+    presets is the presets.PresetStore for the preset field, by default
+    the one shipped with iKneel.
+    """
+    if not isinstance(row, dict):
+        raise ValueError('a job must be an object of job fields, got %r' % (row,))
+    if None in row:
+        # csv.DictReader files the cells past the header under None
+        raise ValueError('too many columns: %r' % (row[None],))
+    unknown = set(row) - set(FIELDS) - {'preset'}
+    if unknown:
+        raise ValueError('unknown job field(s): ' + ', '.join(sorted(unknown)))
+    preset = {}
+    if row.get('preset'):
+        try:
+            preset = (presets or preset_store()).get(row['preset'])
+        except KeyError as err:
+            raise ValueError(err.args[0])
+        preset = dict(preset, material=preset['name'])
+    job = {'ambient': preset.get('ambient', AMBIENT)}
+    for name in FIELDS:
+        value = row.get(name)
+        if value is None or value == '':
+            value = preset.get(name)
+        if value is None:
+            if name == 'ambient':
+                continue
+            raise ValueError('missing job field: ' + name)
+        if name in NUMBERS:
+            value = whole_number(name, value)
+        job[name] = value
+    check_params(job['anneal_temp'], job['heat_rate'], job['soak_time'],
+                 job['cool_rate'], job['ambient'])
+    return job
+
+
+def read_rows(path):
+    """Read a .json or .csv job file into a list of unchecked rows"""
+    if path.lower().endswith('.json'):
+        with open(path) as fi:
+            rows = json.load(fi)
+        if isinstance(rows, dict):
+            rows = [rows]
+        return rows
+    with open(path, newline='') as fi:
+        return list(csv.DictReader(fi))
+
+
+def load_jobs(path, presets=None):
+    """Read a .json or .csv job file and return a list of job dicts"""
+    rows = read_rows(path)
+    jobs = []
+    for number, row in enumerate(rows, 1):
+        try:
+            jobs.append(make_job(row, presets))
+        except ValueError as err:
+            raise ValueError('%s job %d: %s' % (path, number, err))
+    return jobs
+
+
+def job_path(job, out_dir='.', compress=False):
+    """Where a job's program is written, '-' if out_dir is '-' for stdout"""
+    if out_dir == '-':
+        return '-'
+    name = file_name(job['material'], job['anneal_temp'], job['heat_rate'],
+                     job['soak_time'], job['cool_rate'])
+    return os.path.join(out_dir, name + ('.gcode.gz' if compress else '.gcode'))
+
+
+def job_args(job):
+    """The positional generate_anneal arguments for a job"""
+    return (job['material'], job['anneal_temp'], job['heat_rate'],
+            job['soak_time'], job['cool_rate'], job['ambient'])
+
+
+def run_job(job, out_dir='.', compress=False, cache=None, **options):
+    """Generate one job's program, returning (path, writer.Written)
+
+    options are passed on to write_anneal, e.g. compact=10. With a
+    cache.ProgramCache a program made before is linked into place instead,
+    and Written.writes is 0.
+    """
+    path = job_path(job, out_dir, compress)
+    if cache is None:
+        return path, write_anneal(path, *job_args(job), compress=compress, **options)
+    key = cache.key(job_args(job), dict(options, compress=compress))
+    written = cache.fetch(key, path)
+    if written is not None:
+        metrics.hit()
+        return path, written
+    temp = cache.temp_path(key)
+    written = write_anneal(temp, *job_args(job), compress=compress, **options)
+    cache.store(key, temp, written)
+    if cache.fetch(key, path) is None:
+        raise OSError('cached program %s vanished before it could be used' % key)
+    return path, written
+
+
+def run_batch(jobs, out_dir='.', **options):
+    """Generate every job in order, yielding (path, writer.Written) for each"""
+    if out_dir != '-':
+        os.makedirs(out_dir, exist_ok=True)
+    for job in jobs:
+        yield run_job(job, out_dir, **options)
+
+
+# One job's outcome. written is the writer.Written for the program and full
+# the size the uncompacted program would have been, when compacting.
+# path is None and error is set when the job failed.
+JobResult = namedtuple('JobResult', 'index row path written full error')
+
+
+def _pool_job(item):
+    # Runs in a worker process, so everything in and out must pickle
+    index, row, out_dir, presets, options = item
+    try:
+        job = make_job(row, presets)
+        path, written = run_job(job, out_dir, **options)
+        full = None
+        if options.get('compact') or options.get('max_lines') or options.get('max_bytes'):
+            full = measure(iter_anneal(*job_args(job)))
+        return JobResult(index, row, path, written, full, None)
+    except Exception as err:
+        return JobResult(index, row, None, None, None,
+                         '%s: %s' % (type(err).__name__, err))
+
+
+def run_pool(rows, out_dir='.', workers=None, presets=None, **options):
+    """Generate every row, yielding a JobResult per row in row order
+
+    rows are checked inside the workers, so they may come straight from
+    read_rows(). workers defaults to the number of CPUs; 1 runs everything
+    in this process, as does out_dir '-' so programs reach stdout whole
+    and in order. presets is passed on to make_job and options to
+    write_anneal.
+    """
+    items = [(index, row, out_dir, presets, options) for index, row in enumerate(rows)]
+    if out_dir == '-':
+        workers = 1
+    else:
+        os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(items) <= 1:
+        for item in items:
+            yield _pool_job(item)
+    else:
+        # Programs take around a millisecond each, so hand them out in chunks
+        # big enough to hide the pickling but small enough to keep every
+        # worker busy until the end of the run.
+        chunksize = max(1, len(items) // (workers * 16))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(_pool_job, items, chunksize=chunksize):
+                yield result
+    if options.get('cache') is not None:
+        options['cache'].evict()
@@ -0,0 +1,208 @@
+"""
+Benchmarks of generation throughput, output size and memory.
+
+    python -m ikneel bench -o before.json
+    ... change things ...
+    python -m ikneel bench -o after.json --compare before.json
+
+Every CASE, the corners of the ranges the prompts accept, is generated in
+every output MODE, into os.devnull through writer.write_records just as a
+real run writes files. For each the results give lines and bytes per
+second (best of ROUNDS timed rounds), the output size and the peak memory
+Python allocates while generating it (tracemalloc, in a separate run as it
+slows everything down). The batch benchmark generates thousands of jobs
+spread over the same ranges into a temporary directory with run_pool.
+
+Results are JSON, so two commits can be compared with compare(): sizes
+and memory should not change at all unless the output did, throughput is
+flagged when it drops by more than the threshold.
+"""
+
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from . import __version__
+from .batch import run_pool
+from .gcode import LIMITS, iter_anneal
+from .writer import write_records
+
+# (name, anneal_temp, heat_rate, soak_time, cool_rate): the shortest and
+# longest programs allowed, the widest ramps at each end of the rates and a
+# typical PLA job
+CASES = (
+    ('shortest', 50, 28, 6, 28),
+    ('typical', 80, 20, 60, 10),
+    ('slow-ramps', 120, 11, 6, 6),
+    ('long-soak', 50, 28, 999, 28),
+    ('longest', 120, 11, 999, 6),
+)
+MODES = {
+    'legacy': {},
+    'compact': {'compact': 10},
+    'exact': {'exact': True},
+    'exact-fine': {'exact': True, 'step': 0.1},
+    'commands': {'exact': True, 'commands': 50},
+    'rrf': {'firmware': 'rrf'},
+    'klipper': {'firmware': 'klipper'},
+}
+ROUNDS = 3
+# Seconds each timed round runs for at least
+MIN_TIME = 0.2
+BATCH_JOBS = 2000
+# Fractional drop in throughput flagged by compare()
+THRESHOLD = 0.10
+
+
+def git_commit():
+    """The commit being benchmarked, None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_program(args, options, rounds=ROUNDS, min_time=MIN_TIME):
+    """(best seconds per program, writer.Written) writing one program to os.devnull"""
+    with open(os.devnull, 'w') as sink:
+        started = time.perf_counter()
+        written = write_records(iter_anneal('PLA', *args, **options), sink)
+        once = max(time.perf_counter() - started, 1e-6)
+        number = max(1, int(min_time / once))
+        best = once
+        for _ in range(rounds):
+            started = time.perf_counter()
+            for _ in range(number):
+                write_records(iter_anneal('PLA', *args, **options), sink)
+            best = min(best, (time.perf_counter() - started) / number)
+    return best, written
+
+
+def peak_memory(args, options):
+    """Bytes allocated at the peak while writing one program to os.devnull"""
+    with open(os.devnull, 'w') as sink:
+        tracemalloc.start()
+        try:
+            write_records(iter_anneal('PLA', *args, **options), sink)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+def bench_case(case, mode, rounds=ROUNDS, min_time=MIN_TIME):
+    """The result dict of one case in one mode"""
+    name, args = case[0], case[1:]
+    options = MODES[mode]
+    seconds, written = time_program(args, options, rounds, min_time)
+    return {'case': name, 'mode': mode, 'args': list(args), 'lines': written.lines,
+            'bytes': written.size, 'writes': written.writes, 'seconds': seconds,
+            'lines_per_sec': written.lines / seconds, 'bytes_per_sec': written.size / seconds,
+            'peak_memory': peak_memory(args, options)}
+
+
+def batch_rows(count, seed=0):
+    """count job rows spread evenly at random over the prompt ranges"""
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(count):
+        row = {'material': 'PLA'}
+        for name, (minimum, maximum) in LIMITS.items():
+            row[name] = rng.randint(minimum, maximum)
+        rows.append(row)
+    return rows
+
+
+def bench_batch(count=BATCH_JOBS, workers=1, **options):
+    """Generate count jobs into a temporary directory with run_pool, returning a dict"""
+    rows = batch_rows(count)
+    lines = size = failed = 0
+    with tempfile.TemporaryDirectory(prefix='ikneel-bench-') as out_dir:
+        started = time.perf_counter()
+        for result in run_pool(rows, out_dir, workers, **options):
+            if result.error:
+                failed += 1
+            else:
+                lines += result.written.lines
+                size += result.written.size
+        seconds = time.perf_counter() - started
+    return {'jobs': count, 'workers': workers, 'options': options, 'failed': failed,
+            'lines': lines, 'bytes': size, 'seconds': seconds, 'jobs_per_sec': count / seconds,
+            'lines_per_sec': lines / seconds, 'bytes_per_sec': size / seconds}
+
+
+def run(cases=CASES, modes=tuple(MODES), rounds=ROUNDS, min_time=MIN_TIME,
+        batch=BATCH_JOBS, workers=1, progress=None):
+    """Every case in every mode and the batch benchmark, as a JSON-ready dict
+
+    progress, if given, is called with each result dict as it is made.
+    batch 0 leaves the batch benchmark out.
+    """
+    results = []
+    for case in cases:
+        for mode in modes:
+            result = bench_case(case, mode, rounds, min_time)
+            results.append(result)
+            if progress:
+                progress(result)
+    report = {'version': __version__, 'commit': git_commit(), 'time': time.time(),
+              'python': platform.python_version(), 'machine': platform.machine(),
+              'cpus': os.cpu_count(), 'results': results, 'batch': None}
+    if batch:
+        report['batch'] = bench_batch(batch, workers)
+        if progress:
+            progress(report['batch'])
+    return report
+
+
+def load(path):
+    with open(path) as fi:
+        return json.load(fi)
+
+
+def save(report, path):
+    with open(path, 'w') as fo:
+        json.dump(report, fo, indent=1)
+        fo.write('\n')
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """Lines comparing two reports, and whether any of them is a regression
+
+    Throughput is a regression when it drops by more than threshold;
+    output size and peak memory when they grow at all beyond threshold.
+    """
+    lines = []
+    regressed = False
+    before = {(result['case'], result['mode']): result for result in old['results']}
+    for result in new['results']:
+        was = before.get((result['case'], result['mode']))
+        if was is None:
+            continue
+        speed = result['lines_per_sec'] / was['lines_per_sec'] - 1
+        memory = result['peak_memory'] / max(was['peak_memory'], 1) - 1
+        notes = []
+        if speed < -threshold:
+            notes.append('slower')
+        if result['bytes'] != was['bytes']:
+            notes.append('output %+d bytes' % (result['bytes'] - was['bytes']))
+            regressed = regressed or result['bytes'] > was['bytes'] * (1 + threshold)
+        if memory > threshold:
+            notes.append('more memory')
+        regressed = regressed or speed < -threshold or memory > threshold
+        lines.append('%-11s %-10s %10.0f lines/s %+6.1f%%  peak %6.1f KB %+6.1f%%  %s' % (
+            result['case'], result['mode'], result['lines_per_sec'], 100 * speed,
+            result['peak_memory'] / 1024.0, 100 * memory, ', '.join(notes)))
+    if old.get('batch') and new.get('batch'):
+        speed = new['batch']['jobs_per_sec'] / old['batch']['jobs_per_sec'] - 1
+        regressed = regressed or speed < -threshold
+        lines.append('batch of %d  %10.0f jobs/s %+6.1f%%  %s' % (
+            new['batch']['jobs'], new['batch']['jobs_per_sec'], 100 * speed,
+            'slower' if speed < -threshold else ''))
+    return lines, regressed
@@ -0,0 +1,144 @@
+"""
+Content addressed cache of generated programs.
+
+A program is keyed by a hash of everything that decides its bytes: the
+anneal parameters, the output options (compact, exact, gzip, ...) and the
+generator version. Asking for the same program again hard links the
+stored file to the output path, or copies it if the two are on different
+file systems, instead of generating it again.
+
+Stored files are read only. open_output() writes a new file and renames
+it over the output, which breaks any link, so regenerating into the same
+place cannot change what is cached.
+
+The least recently used programs are removed once there are more than
+max_entries of them or they take more than max_bytes.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from . import __version__, metrics
+from .writer import Written
+
+# Remove old entries after this many stores, and at the end of a batch
+EVICT_EVERY = 64
+
+
+def default_dir():
+    """$XDG_CACHE_HOME/ikneel, or ~/.cache/ikneel"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ikneel')
+
+
+def program_key(args, options):
+    """Hash of generate_anneal's positional args and output options"""
+    text = json.dumps({'version': __version__, 'args': list(args),
+                       'options': options}, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ProgramCache:
+    """Generated programs on disk, looked up by cache key"""
+
+    def __init__(self, root=None, max_entries=1000, max_bytes=256 * 1024 * 1024):
+        self.root = root or default_dir()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stores = 0
+
+    def key(self, args, options):
+        return program_key(args, options)
+
+    def entry(self, key):
+        return os.path.join(self.root, key + '.gcode')
+
+    def fetch(self, key, path):
+        """Put the cached program at path ('-' for stdout), returning Written
+
+        Returns None on a miss.
+        """
+        entry = self.entry(key)
+        metrics.clock('file')
+        try:
+            with open(entry + '.json') as fi:
+                meta = json.load(fi)
+            if path == '-':
+                sys.stdout.flush()
+                with open(entry, 'rb') as fi:
+                    shutil.copyfileobj(fi, sys.stdout.buffer)
+                sys.stdout.buffer.flush()
+            else:
+                place(entry, path)
+            # Mark it as recently used for eviction
+            os.utime(entry)
+        except (OSError, ValueError):
+            # Missing, half written or evicted from under us
+            return None
+        finally:
+            metrics.clock(None)
+        return Written(0, meta['lines'], meta['size'])
+
+    def temp_path(self, key):
+        """A private path in the cache to generate a program into for store()"""
+        os.makedirs(self.root, exist_ok=True)
+        return '%s.%d.tmp' % (self.entry(key), os.getpid())
+
+    def store(self, key, temp, written):
+        """Move the program generated at temp_path(key) into the cache"""
+        entry = self.entry(key)
+        metrics.clock('file')
+        os.chmod(temp, 0o444)
+        with open(temp + '.json', 'w') as fo:
+            json.dump({'lines': written.lines, 'size': written.size}, fo)
+        # Rename is atomic, so other processes see all of an entry or none
+        os.replace(temp + '.json', entry + '.json')
+        os.replace(temp, entry)
+        metrics.clock(None)
+        self.stores += 1
+        if self.stores % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until within the limits"""
+        try:
+            names = [name for name in os.listdir(self.root) if name.endswith('.gcode')]
+        except FileNotFoundError:
+            return
+        entries = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        count = len(entries)
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            for victim in (name, name + '.json'):
+                try:
+                    os.remove(os.path.join(self.root, victim))
+                except FileNotFoundError:
+                    pass
+            count -= 1
+            total -= size
+
+    def clear(self):
+        """Remove every cached program"""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def place(entry, path):
+    """Hard link entry to path, copying if they are on different file systems"""
+    if os.path.lexists(path):
+        os.remove(path)
+    try:
+        os.link(entry, path)
+    except OSError:
+        shutil.copyfile(entry, path)
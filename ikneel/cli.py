@@ -0,0 +1,825 @@
+"""
+Non-interactive command line for iKneel.
+
+    python -m ikneel generate --material PLA --temp 80 --heat-rate 20 --soak 60 --cool-rate 10
+    python -m ikneel generate --jobs recipes.csv -o out/ --workers 8
+    python -m ikneel generate --preset PETG --soak 90
+    python -m ikneel generate --preset PETG --firmware rrf
+    python -m ikneel generate --material PLA --temp 80 ... -o - | uploader
+    python -m ikneel simulate --jobs recipes.csv --tau-part 1200
+    python -m ikneel optimize --material PLA --temp 80 --tg 60 --min-above 60 --max-lag 10
+    python -m ikneel send PLA_anneal_80_20_60_10.gcode --port /dev/ttyUSB0
+    python -m ikneel fleet --jobs recipes.csv --port /dev/ttyUSB0 --port /dev/ttyUSB1
+    python -m ikneel closed-loop --preset PETG --port /dev/ttyUSB0
+    python -m ikneel analyze programs/ --workers 0
+    python -m ikneel resume --preset PETG --elapsed 400
+    python -m ikneel profile petg-two-rate.json
+
+No banner and no prompts, so it can be called from a job system.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+from . import metrics
+from .batch import FIELDS, job_args, make_job, read_rows, run_job, run_pool
+from .cache import ProgramCache
+from .firmware import FIRMWARES, KLIPPER_MACROS
+from .presets import store as preset_store
+from .gcode import AMBIENT, file_name
+from .schedule import CHAMBER_MAX
+
+# Rates termios has no constant for are set with termios2 (host.set_baud)
+BAUD_HELP = "baud rate (default 115200); non-standard rates such as Marlin's 250000 need Linux"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='ikneel',
+        description='Generate gcode to use a 3D printers heat bed as an annealing oven')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    gen = commands.add_parser('generate', help='write anneal programs')
+    add_job_args(gen)
+    gen.add_argument('-o', '--out-dir', default='.',
+                     help="directory for the .gcode files, '-' to write programs to stdout")
+    gen.add_argument('-z', '--gzip', action='store_true', help='write gzipped .gcode.gz files')
+    gen.add_argument('--compact', type=int, default=0, metavar='MIN',
+                     help='update the display every MIN minutes and merge soak dwells')
+    gen.add_argument('--max-lines', type=int, metavar='N',
+                     help='make the output compact enough to fit in N lines')
+    gen.add_argument('--max-bytes', type=int, metavar='N',
+                     help='make the output compact enough to fit in N bytes')
+    gen.add_argument('-j', '--workers', type=int, default=1,
+                     help='worker processes for job files, 0 for one per CPU (default 1)')
+    add_schedule_args(gen)
+    add_chamber_args(gen)
+    gen.add_argument('--firmware', choices=FIRMWARES, default='marlin',
+                     help='marlin writes every step out (default); rrf and klipper'
+                          ' write each ramp and the soak as a loop, --step deg C a pass')
+    gen.add_argument('--vectorized', action='store_true',
+                     help='work the whole job file out with NumPy, for large batches of'
+                          ' plain 2.02 style output (no cache)')
+    gen.add_argument('--no-cache', action='store_true',
+                     help='always generate, do not use or fill the program cache')
+    gen.add_argument('--cache-dir', metavar='DIR',
+                     help='program cache directory (default ~/.cache/ikneel)')
+    gen.add_argument('--cache-entries', type=int, default=1000, metavar='N',
+                     help='most programs to keep in the cache (default 1000)')
+    gen.add_argument('--cache-size', type=int, default=256, metavar='MB',
+                     help='most megabytes of programs to keep in the cache (default 256)')
+    gen.add_argument('-q', '--quiet', action='store_true', help='do not list files written')
+    gen.add_argument('--metrics', metavar='FILE',
+                     help='write time, lines, bytes and writes by phase to FILE as JSON')
+    gen.add_argument('--prometheus', action='store_true',
+                     help='write --metrics in the Prometheus text format instead')
+    gen.set_defaults(func=cmd_generate)
+
+    sim = commands.add_parser('simulate', help='predict part temperatures (needs NumPy)')
+    add_job_args(sim)
+    add_schedule_args(sim)
+    add_thermal_args(sim)
+    sim.add_argument('--trace', metavar='FILE',
+                     help='write the first job\'s temperatures to FILE as CSV')
+    sim.set_defaults(func=cmd_simulate)
+
+    pre = commands.add_parser('presets', help='list the material presets')
+    pre.add_argument('--presets', metavar='FILE',
+                     help='JSON or TOML preset file instead of the one shipped with ikneel')
+    pre.set_defaults(func=cmd_presets)
+
+    opt = commands.add_parser('optimize', help='find the shortest cycle that anneals (needs NumPy)')
+    opt.add_argument('--preset', metavar='NAME',
+                     help='material preset giving material, temperature and tg')
+    opt.add_argument('--presets', metavar='FILE',
+                     help='JSON or TOML preset file instead of the one shipped with ikneel')
+    opt.add_argument('--material', help='target material (used for file name)')
+    opt.add_argument('--temp', type=int, dest='anneal_temp',
+                     help='annealing temperature, deg C (50-120)')
+    opt.add_argument('--tg', type=float, help='glass transition temperature, deg C')
+    opt.add_argument('--min-above', type=float, required=True, metavar='MIN',
+                     help='minutes the part must spend at or above tg')
+    opt.add_argument('--max-lag', type=float, required=True, metavar='DEG',
+                     help='most the part may trail the bed setpoint, deg C')
+    opt.add_argument('--ceiling', type=int, metavar='DEG',
+                     help='refuse to run if --temp is above this bed temperature, deg C; every'
+                          ' schedule searched peaks at --temp')
+    opt.add_argument('--ambient', type=int, help='ambient temperature, deg C')
+    add_thermal_args(opt)
+    add_schedule_args(opt)
+    opt.add_argument('-o', '--out-dir', default='.',
+                     help="directory for the .gcode file, '-' to write it to stdout")
+    opt.set_defaults(func=cmd_optimize)
+
+    send = commands.add_parser('send', help='stream a program to a Marlin printer over serial')
+    send.add_argument('file', help='.gcode file to send')
+    send.add_argument('--port', metavar='DEV', help='serial device, e.g. /dev/ttyUSB0')
+    send.add_argument('--baud', type=int, default=115200, help=BAUD_HELP)
+    send.add_argument('--window', type=int, default=4, metavar='N',
+                      help='lines sent ahead of the oks, Marlin\'s BUFSIZE (default 4)')
+    send.add_argument('--timeout', type=float, default=30, metavar='S',
+                      help='seconds of silence, beyond any dwell, before giving up (default 30)')
+    send.add_argument('--simulate', action='store_true',
+                      help='send to a fake printer instead of --port')
+    send.add_argument('--speedup', type=float, default=60, metavar='N',
+                      help='with --simulate, run the fake printer N times faster (default 60)')
+    send.set_defaults(func=cmd_send)
+
+    fleet = commands.add_parser('fleet', help='run a queue of jobs on several printers at once')
+    add_job_args(fleet)
+    add_schedule_args(fleet)
+    fleet.add_argument('--port', action='append', default=[], metavar='DEV',
+                       help='a printer\'s serial device; give once per printer')
+    fleet.add_argument('--baud', type=int, default=115200, help=BAUD_HELP)
+    fleet.add_argument('--timeout', type=float, default=30, metavar='S',
+                       help='seconds of silence, beyond any dwell, before giving up (default 30)')
+    fleet.add_argument('--simulate', type=int, default=0, metavar='N',
+                       help='run on N fake printers instead of --port')
+    fleet.add_argument('--speedup', type=float, default=60, metavar='N',
+                       help='with --simulate, run the fake printers N times faster (default 60)')
+    fleet.add_argument('--interval', type=float, default=60, metavar='S',
+                       help='seconds between progress reports (default 60)')
+    fleet.set_defaults(func=cmd_fleet)
+
+    loop = commands.add_parser('closed-loop',
+                               help='run one cycle from the host, adapting to the measured bed')
+    add_job_args(loop)
+    add_schedule_args(loop)
+    loop.add_argument('--port', metavar='DEV', help='serial device, e.g. /dev/ttyUSB0')
+    loop.add_argument('--baud', type=int, default=115200, help=BAUD_HELP)
+    loop.add_argument('--timeout', type=float, default=30, metavar='S',
+                      help='seconds of silence, beyond any dwell, before giving up (default 30)')
+    loop.add_argument('--gain', type=float, default=1.0,
+                      help='degrees of ramp time added to a dwell per degree the lag grew over'
+                           ' the last step, taken off when it shrank (default 1)')
+    loop.add_argument('--min-dwell', type=float, default=0.5, metavar='F',
+                      help='shortest dwell, as a fraction of the open loop one (default 0.5)')
+    loop.add_argument('--max-dwell', type=float, default=3.0, metavar='F',
+                      help='longest dwell, as a multiple of the open loop one (default 3)')
+    loop.add_argument('--simulate', action='store_true',
+                      help='run on a fake printer instead of --port')
+    loop.add_argument('--speedup', type=float, default=60, metavar='N',
+                      help='with --simulate, run the fake printer N times faster (default 60)')
+    loop.add_argument('--bed-tau', type=float, default=120, metavar='S',
+                      help='with --simulate, the bed\'s time constant, seconds (default 120)')
+    loop.add_argument('--bed-max-rate', type=float, metavar='DEG',
+                      help='with --simulate, the fastest the bed heats, deg C per hour')
+    loop.add_argument('--bed-start', type=float, metavar='DEG',
+                      help='with --simulate, the bed temperature at the start, deg C')
+    loop.set_defaults(func=cmd_closed_loop)
+
+    ana = commands.add_parser('analyze', help='check programs against their headers')
+    ana.add_argument('paths', nargs='+', metavar='PATH',
+                     help='.gcode or .gcode.gz files, or directories of them')
+    ana.add_argument('-j', '--workers', type=int, default=1,
+                     help='worker processes, 0 for one per CPU (default 1)')
+    ana.add_argument('--tolerance', type=float, default=2, metavar='PCT',
+                     help='difference from the header flagged, percent (default 2)')
+    ana.add_argument('--max-jump', type=float, default=5, metavar='DEG',
+                     help='largest setpoint change between steps not flagged (default 5)')
+    ana.add_argument('--profile', metavar='FILE',
+                     help='write the first program\'s setpoint against time to FILE as CSV')
+    ana.add_argument('-q', '--quiet', action='store_true', help='only list flagged programs')
+    ana.set_defaults(func=cmd_analyze)
+
+    res = commands.add_parser('resume', help='write the rest of a cycle from part way through')
+    add_job_args(res)
+    add_schedule_args(res)
+    res.add_argument('--elapsed', type=float, metavar='MIN',
+                     help='minutes since the cycle started')
+    res.add_argument('--bed', type=float, metavar='DEG',
+                     help='bed temperature now, with --phase, to carry on a ramp from')
+    res.add_argument('--phase', choices=('heat', 'cool'), help='the ramp --bed was read in')
+    res.add_argument('--compact', type=int, default=0, metavar='MIN',
+                     help='update the display every MIN minutes and merge soak dwells')
+    res.add_argument('-o', '--out-dir', default='.',
+                     help="directory for the .gcode file, '-' to write it to stdout")
+    res.set_defaults(func=cmd_resume)
+
+    prof = commands.add_parser('profile', help='write the program for a profile of stages')
+    prof.add_argument('file', help='JSON or TOML profile file')
+    prof.add_argument('-o', '--out-dir', default='.',
+                      help="directory for the .gcode file, '-' to write it to stdout")
+    prof.add_argument('-z', '--gzip', action='store_true', help='write a gzipped .gcode.gz file')
+    prof.add_argument('--compact', type=int, default=0, metavar='MIN',
+                      help='update the display every MIN minutes')
+    prof.add_argument('--step', type=float, default=1, metavar='DEG',
+                      help='deg C per ramp step, may be fractional (default 1)')
+    add_chamber_args(prof)
+    prof.set_defaults(func=cmd_profile)
+
+    idx = commands.add_parser('index', help='write byte offset indexes for hosts to seek by time')
+    idx.add_argument('paths', nargs='+', metavar='FILE', help='.gcode files')
+    idx.set_defaults(func=cmd_index)
+
+    macros = commands.add_parser('klipper-macros',
+                                 help='print the printer.cfg macros for --firmware klipper')
+    macros.set_defaults(func=cmd_klipper_macros)
+
+    fake = commands.add_parser('fakemarlin', help='run a fake Marlin printer on a pty')
+    fake.add_argument('--speedup', type=float, default=60, metavar='N',
+                      help='run N times faster than real time (default 60)')
+    fake.add_argument('--error-rate', type=float, default=0, metavar='P',
+                      help='fraction of lines to treat as damaged (default 0)')
+    fake.set_defaults(func=cmd_fakemarlin)
+
+    serve = commands.add_parser('serve', help='serve programs over HTTP')
+    serve.add_argument('--host', default='127.0.0.1',
+                       help='address to listen on (default 127.0.0.1)')
+    serve.add_argument('--port', type=int, default=8080, help='port (default 8080)')
+    serve.add_argument('--presets', metavar='FILE',
+                       help='presets file to use instead of the usual ones')
+    serve.add_argument('--cache-entries', type=int, default=256, metavar='N',
+                       help='programs kept in memory (default 256)')
+    serve.add_argument('--cache-size', type=float, default=64, metavar='MB',
+                       help='memory for kept programs (default 64 MB)')
+    serve.set_defaults(func=cmd_serve)
+
+    load = commands.add_parser('loadtest', help='measure the HTTP service under load')
+    load.add_argument('url', help='an /anneal url of the service')
+    load.add_argument('-c', '--concurrency', type=int, default=8, metavar='N',
+                      help='connections at once (default 8)')
+    load.add_argument('-n', '--requests', type=int, default=1000, metavar='N',
+                      help='requests in all (default 1000)')
+    load.add_argument('--distinct', type=int, default=1, metavar='N',
+                      help='vary the soak time over N values to miss the cache (default 1)')
+    load.set_defaults(func=cmd_loadtest)
+
+    bench = commands.add_parser('bench', help='benchmark generation speed, size and memory')
+    bench.add_argument('-o', '--output', metavar='FILE', help='save the results as JSON')
+    bench.add_argument('--compare', nargs='+', metavar='FILE',
+                       help='compare against saved results; with two files, compare those'
+                            ' without running anything')
+    bench.add_argument('--threshold', type=float, default=10, metavar='PCT',
+                       help='slowdown flagged by --compare (default 10%%)')
+    bench.add_argument('--mode', action='append', metavar='MODE',
+                       help='output mode to run, repeatable (default all)')
+    bench.add_argument('--batch', type=int, default=2000, metavar='N',
+                       help='jobs in the batch benchmark, 0 to skip it (default 2000)')
+    bench.add_argument('-j', '--workers', type=int, default=1,
+                       help='worker processes for the batch, 0 for one per CPU (default 1)')
+    bench.add_argument('--quick', action='store_true',
+                       help='one short round each, for a rough idea')
+    bench.set_defaults(func=cmd_bench)
+    return parser
+
+
+def add_job_args(parser):
+    parser.add_argument('--jobs', metavar='FILE',
+                        help='JSON or CSV job file, one program per entry')
+    parser.add_argument('--preset', metavar='NAME',
+                        help='material preset, e.g. PETG; other flags override its values')
+    parser.add_argument('--presets', metavar='FILE',
+                        help='JSON or TOML preset file instead of the one shipped with ikneel')
+    parser.add_argument('--material', help='target material (used for file name)')
+    parser.add_argument('--temp', type=int, dest='anneal_temp',
+                        help='annealing temperature, deg C (50-120)')
+    parser.add_argument('--heat-rate', type=int, help='heating rate, deg C per hour (11-28)')
+    parser.add_argument('--soak', type=int, dest='soak_time',
+                        help='soak time before starting ramp down, minutes (6-999)')
+    parser.add_argument('--cool-rate', type=int, help='cooling rate, deg C per hour (6-28)')
+    parser.add_argument('--ambient', type=int, help='ambient temperature, deg C')
+
+
+def add_schedule_args(parser):
+    parser.add_argument('--exact', action='store_true',
+                        help='drift free timing instead of the version 2.02 one degree steps')
+    parser.add_argument('--step', type=float, default=1, metavar='DEG',
+                        help='with --exact, deg C per ramp step, may be fractional (default 1)')
+    parser.add_argument('--commands', type=int, metavar='N',
+                        help='with --exact, cut the ramps into N setpoint changes in all')
+
+
+def add_chamber_args(parser):
+    parser.add_argument('--chamber-offset', type=float, metavar='DEG',
+                        help='also drive the chamber heater (M141) at the bed setpoint plus DEG,'
+                             ' e.g. -20')
+    parser.add_argument('--chamber-lag', type=float, default=0, metavar='MIN',
+                        help='chamber follows the bed setpoint MIN minutes late, or early if'
+                             ' negative (default 0)')
+    parser.add_argument('--chamber-max', type=float, default=CHAMBER_MAX, metavar='DEG',
+                        help='highest chamber setpoint (default %d)' % CHAMBER_MAX)
+
+
+def chamber_options(args, parser):
+    """The chamber keyword arguments, none at all without --chamber-offset"""
+    if args.chamber_offset is None:
+        if args.chamber_lag or args.chamber_max != CHAMBER_MAX:
+            parser.error('--chamber-lag and --chamber-max need --chamber-offset')
+        return {}
+    for value in (args.chamber_offset, args.chamber_lag, args.chamber_max):
+        if not math.isfinite(value):
+            parser.error('--chamber-offset, --chamber-lag and --chamber-max must be finite')
+    return {'chamber_offset': args.chamber_offset, 'chamber_lag': args.chamber_lag,
+            'chamber_max': args.chamber_max}
+
+
+def add_thermal_args(parser):
+    parser.add_argument('--tau-bed', type=float, default=300, metavar='S',
+                        help='bed time constant, seconds (default 300)')
+    parser.add_argument('--tau-air', type=float, default=600, metavar='S',
+                        help='air under the box time constant, seconds (default 600)')
+    parser.add_argument('--tau-part', type=float, default=900, metavar='S',
+                        help='part time constant, seconds (default 900)')
+    parser.add_argument('--dt', type=float, default=30, metavar='S',
+                        help='seconds between samples (default 30)')
+
+
+def row_label(row):
+    """What to call a job row in a failure report"""
+    if isinstance(row, dict):
+        return row.get('material') or row.get('preset')
+    return repr(row)
+
+
+def job_rows(args, parser):
+    """Unchecked job rows from --jobs or from the parameter flags"""
+    if (args.step != 1 or args.commands) and not args.exact \
+            and getattr(args, 'firmware', 'marlin') == 'marlin':
+        parser.error('--step and --commands need --exact')
+    if args.jobs:
+        return read_rows(args.jobs)
+    row = {name: getattr(args, name) for name in FIELDS}
+    missing = [name for name, value in row.items() if value is None and name != 'ambient']
+    if missing and not args.preset:
+        parser.error('give --jobs, --preset or all of'
+                     ' --material --temp --heat-rate --soak --cool-rate')
+    row['preset'] = args.preset
+    return [row]
+
+
+def presets_arg(args):
+    return preset_store(args.presets) if args.presets else None
+
+
+def size_change(written, full):
+    """Describe a compacted program's size against the full output"""
+    return '%d lines, %d bytes; full output %d lines, %d bytes, %.0f%% smaller' % (
+        written.lines, written.size, full.lines, full.size,
+        100 - 100.0 * written.size / full.size)
+
+
+def cmd_generate(args, parser):
+    rows = job_rows(args, parser)
+    if args.workers < 0:
+        parser.error('--workers must be 0 or more')
+    if args.metrics and args.workers != 1:
+        parser.error('--metrics records this process only, use it with -j 1')
+    if args.vectorized:
+        return generate_vectorized(args, parser, rows)
+
+    cache = None
+    if not args.no_cache:
+        cache = ProgramCache(args.cache_dir, args.cache_entries, args.cache_size * 1024 * 1024)
+
+    # Progress goes to stderr when stdout carries the gcode
+    report = sys.stderr if args.out_dir == '-' else sys.stdout
+    failed = []
+    width = len(str(len(rows)))
+    saved = [0, 0]
+    # Only named when not the default, so plain Marlin cache keys stay as they were
+    extra = chamber_options(args, parser)
+    if args.firmware != 'marlin':
+        extra['firmware'] = args.firmware
+    recorder = metrics.recording() if args.metrics else nullcontext()
+    with recorder as recorded:
+        for result in run_pool(rows, args.out_dir, args.workers, presets_arg(args),
+                               compress=args.gzip,
+                               compact=args.compact, max_lines=args.max_lines,
+                               max_bytes=args.max_bytes, exact=args.exact,
+                               step=args.step, commands=args.commands, cache=cache,
+                               **extra):
+            if result.error:
+                failed.append(result)
+                line = 'FAILED ' + result.error
+            else:
+                line = result.path
+                if not result.written.writes:
+                    line += ' (cached)'
+                if result.full:
+                    saved[0] += result.full.size
+                    saved[1] += result.written.size
+                    line += ' (%s)' % size_change(result.written, result.full)
+            if not args.quiet or result.error:
+                print('[%*d/%d] %s' % (width, result.index + 1, len(rows), line),
+                      file=report, flush=True)
+    if args.metrics:
+        with open(args.metrics, 'w') as fo:
+            fo.write(recorded.prometheus() if args.prometheus else recorded.json() + '\n')
+    if len(rows) > 1:
+        print('%d written, %d failed' % (len(rows) - len(failed), len(failed)), file=sys.stderr)
+        if saved[0]:
+            print('compact output is %d bytes, %.0f%% smaller than the full %d bytes'
+                  % (saved[1], 100 - 100.0 * saved[1] / saved[0], saved[0]), file=sys.stderr)
+    for result in failed:
+        print('  job %d (%s): %s' % (result.index + 1, row_label(result.row), result.error),
+              file=sys.stderr)
+    return 1 if failed else 0
+
+
+def generate_vectorized(args, parser, rows):
+    from .vectorized import write_programs
+
+    if (args.compact or args.max_lines or args.max_bytes or args.exact or args.metrics
+            or args.firmware != 'marlin' or chamber_options(args, parser)):
+        parser.error('--vectorized only writes the plain output, without --compact,'
+                     ' --max-lines, --max-bytes, --exact, --firmware, --metrics or a chamber')
+    jobs = []
+    failed = 0
+    for index, row in enumerate(rows):
+        try:
+            jobs.append(make_job(row, presets_arg(args)))
+        except ValueError as err:
+            failed += 1
+            print('  job %d (%s): %s' % (index + 1, row_label(row), err), file=sys.stderr)
+    report = sys.stderr if args.out_dir == '-' else sys.stdout
+    started = time.monotonic()
+    size = 0
+    for path, written in write_programs(jobs, args.out_dir, args.gzip):
+        size += written.size
+        if not args.quiet:
+            print(path, file=report)
+    seconds = time.monotonic() - started
+    print('%d written, %d failed; %.1f MB in %.2f s' % (len(jobs), failed, size / 1e6, seconds),
+          file=sys.stderr)
+    return 1 if failed else 0
+
+
+def cmd_simulate(args, parser):
+    from . import thermal
+
+    jobs = [make_job(row, presets_arg(args)) for row in job_rows(args, parser)]
+    setpoints = [thermal.schedule_setpoints(*job_args(job)[1:], dt=args.dt, exact=args.exact,
+                                            step=args.step, commands=args.commands)
+                 for job in jobs]
+    traces = thermal.simulate(setpoints, args.tau_bed, args.tau_air, args.tau_part,
+                              [job['ambient'] for job in jobs], args.dt)
+    result = thermal.summary(traces, [job['anneal_temp'] for job in jobs])
+    print('%-32s %8s %8s %10s' % ('job', 'max lag', 'peak', 'soaked'))
+    for index, job in enumerate(jobs):
+        print('%-32s %6.1f C %6.1f C %6.0f min' % (
+            file_name(*job_args(job)[:5]), result['max_lag'][index],
+            result['peak'][index], result['soaked'][index]))
+    if args.trace:
+        with open(args.trace, 'w') as fo:
+            fo.write('minutes,setpoint,bed,air,part\n')
+            for sample in range(traces.length[0]):
+                fo.write('%.2f,%.1f,%.2f,%.2f,%.2f\n' % (
+                    sample * args.dt / 60, traces.setpoint[0, sample], traces.bed[0, sample],
+                    traces.air[0, sample], traces.part[0, sample]))
+    return 0
+
+
+def cmd_presets(args, parser):
+    presets = preset_store(args.presets)
+    for name in presets.names():
+        preset = presets.get(name)
+        print('%-12s %3d %2d %3d %2d  %s' % (
+            name, preset['anneal_temp'], preset['heat_rate'], preset['soak_time'],
+            preset['cool_rate'], preset.get('note', '')))
+    return 0
+
+
+def cmd_optimize(args, parser):
+    from .optimize import optimize
+
+    if (args.step != 1 or args.commands) and not args.exact:
+        parser.error('--step and --commands need --exact')
+    if args.preset:
+        try:
+            preset = preset_store(args.presets).get(args.preset)
+        except KeyError as err:
+            raise ValueError(err.args[0])
+        for name, value in (('material', preset['name']), ('anneal_temp', preset['anneal_temp']),
+                            ('tg', preset.get('tg')), ('ambient', preset.get('ambient'))):
+            if getattr(args, name) is None:
+                setattr(args, name, value)
+    if args.material is None or args.anneal_temp is None or args.tg is None:
+        parser.error('give --preset or all of --material --temp --tg')
+    ambient = AMBIENT if args.ambient is None else args.ambient
+    options = dict(exact=args.exact, step=args.step, commands=args.commands)
+    best, candidates = optimize(args.anneal_temp, args.tg, args.min_above, args.max_lag,
+                                args.ceiling, ambient,
+                                (args.tau_bed, args.tau_air, args.tau_part), args.dt, **options)
+    job = make_job({'material': args.material, 'anneal_temp': args.anneal_temp,
+                    'heat_rate': best.heat_rate, 'soak_time': best.soak_time,
+                    'cool_rate': best.cool_rate, 'ambient': ambient})
+    if args.out_dir != '-':
+        os.makedirs(args.out_dir, exist_ok=True)
+    path, written = run_job(job, args.out_dir, **options)
+    report = sys.stderr if path == '-' else sys.stdout
+    print('%d of %d schedules pass; fastest is heat %d, soak %d, cool %d:'
+          ' %.0f min, part lags up to %.1f C, %.0f min above tg'
+          % (sum(candidate.ok for candidate in candidates), len(candidates),
+             best.heat_rate, best.soak_time, best.cool_rate, best.minutes,
+             best.max_lag, best.above), file=report)
+    print(path, file=report)
+    return 0
+
+
+def send_progress():
+    """A progress callback printing every 5% of a send"""
+    shown = [-1]
+
+    def progress(done, total, seconds):
+        percent = 100 * done // total
+        if percent // 5 != shown[0] // 5 or done == total:
+            shown[0] = percent
+            print('%3d%%  %d/%d lines, %.1f h of program run'
+                  % (percent, done, total, seconds / 3600.0), file=sys.stderr)
+    return progress
+
+
+async def send_program(args):
+    from . import host
+
+    if not args.simulate:
+        return await host.send_file(args.file, args.port, args.baud, args.window,
+                                    args.timeout, progress=send_progress())
+    from .fakemarlin import FakeMarlin
+    async with FakeMarlin(args.speedup) as printer:
+        return await host.send_file(args.file, printer.path, args.baud, args.window,
+                                    args.timeout, 1.0 / args.speedup, send_progress())
+
+
+def cmd_send(args, parser):
+    if bool(args.port) == args.simulate:
+        parser.error('give one of --port and --simulate')
+    stats = asyncio.run(send_program(args))
+    print('sent %d lines in %.1f s, %d resends' % (stats.lines, stats.seconds, stats.resends))
+    return 0
+
+
+def fleet_report(fleet):
+    """Print each printer's progress and when the queue should be done"""
+    now = time.time()
+    for status in fleet.status():
+        if status.state != 'busy':
+            print('%-12s %s' % (status.name, status.state), file=sys.stderr)
+            continue
+        print('%-12s %-32s %3d%%  done %s' % (
+            status.name, file_name(*job_args(status.job)[:5]),
+            100 * status.done // max(status.total, 1),
+            time.strftime('%H:%M:%S', time.localtime(now + status.remaining))), file=sys.stderr)
+    left = fleet.estimate()
+    if left is not None:
+        print('queue done %s' % time.strftime('%H:%M:%S', time.localtime(now + left)),
+              file=sys.stderr)
+
+
+async def run_fleet(args, jobs):
+    from .fleet import Fleet, simulated
+
+    options = dict(exact=args.exact, step=args.step, commands=args.commands)
+    if not args.simulate:
+        fleet = Fleet(args.port, baud=args.baud, timeout=args.timeout, **options)
+        return await fleet.run(jobs, fleet_report, args.interval)
+    async with simulated(args.simulate, args.speedup) as printers:
+        fleet = Fleet([printer.path for printer in printers],
+                      ['sim%d' % number for number in range(1, len(printers) + 1)],
+                      baud=args.baud, timeout=args.timeout,
+                      time_scale=1.0 / args.speedup, **options)
+        return await fleet.run(jobs, fleet_report, args.interval)
+
+
+def cmd_fleet(args, parser):
+    if bool(args.port) == bool(args.simulate):
+        parser.error('give --port for each printer or --simulate N')
+    jobs = [make_job(row, presets_arg(args)) for row in job_rows(args, parser)]
+    failed = 0
+    for result in asyncio.run(run_fleet(args, jobs)):
+        name = file_name(*job_args(result.job)[:5])
+        if result.error:
+            failed += 1
+            print('%-32s %-12s FAILED %s' % (name, result.printer or '-', result.error))
+        else:
+            print('%-32s %-12s %d lines, %d resends, %.1f h' % (
+                name, result.printer, result.stats.lines, result.stats.resends,
+                result.stats.program_seconds / 3600.0))
+    return 1 if failed else 0
+
+
+async def run_closed_loop(args, job):
+    from . import closedloop, host
+
+    options = dict(gain=args.gain, min_dwell=args.min_dwell, max_dwell=args.max_dwell,
+                   exact=args.exact, step=args.step, commands=args.commands)
+
+    def progress(phase, setpoint, bed):
+        print('%-5s setpoint %5s C  bed %6.2f C' % (phase, setpoint, bed), file=sys.stderr)
+
+    async def run(port, time_scale=1.0):
+        sender = await host.connect(port, args.baud, timeout=args.timeout,
+                                    time_scale=time_scale)
+        try:
+            return await closedloop.anneal(sender, *job_args(job)[1:], progress=progress,
+                                           **options)
+        finally:
+            sender.close()
+
+    if not args.simulate:
+        return await run(args.port)
+    from .fakemarlin import Bed, FakeMarlin
+    max_rate = args.bed_max_rate / 3600.0 if args.bed_max_rate else None
+    bed = Bed(job['ambient'], args.bed_tau, max_rate, args.bed_start)
+    async with FakeMarlin(args.speedup, bed=bed) as printer:
+        return await run(printer.path, 1.0 / args.speedup)
+
+
+def cmd_closed_loop(args, parser):
+    if bool(args.port) == args.simulate:
+        parser.error('give one of --port and --simulate')
+    rows = job_rows(args, parser)
+    if len(rows) != 1:
+        parser.error('closed-loop runs one job at a time')
+    job = make_job(rows[0], presets_arg(args))
+    stats = asyncio.run(run_closed_loop(args, job))
+    print('bed started at %.1f C; ran %.1f h against %.1f h open loop,'
+          ' bed trailed by up to %.1f C%s' % (
+              stats.start, stats.seconds / 3600.0, stats.nominal / 3600.0, stats.max_lag,
+              '' if stats.settled else '; never reached the soak temperature'))
+    return 0
+
+
+def rate_text(rate):
+    return '-' if rate is None else '%.1f' % rate
+
+
+def cmd_analyze(args, parser):
+    from .analyze import analyze_many
+
+    if args.workers < 0:
+        parser.error('--workers must be 0 or more')
+    started = time.monotonic()
+    files = size = flagged = 0
+    for result in analyze_many(args.paths, args.workers, args.tolerance / 100.0,
+                               args.max_jump):
+        if args.profile and not files:
+            with open(args.profile, 'w') as fo:
+                fo.write('minutes,setpoint\n')
+                for seconds, setpoint in result.profile:
+                    fo.write('%.2f,%g\n' % (seconds / 60, setpoint))
+        files += 1
+        size += result.size
+        if result.flags:
+            flagged += 1
+            print('%s: %s' % (result.path, '; '.join(result.flags)))
+        elif not args.quiet:
+            print('%s: ok, %.1f h, heat %s C/h, hold %.0f min at %g C, cool %s C/h,'
+                  ' steps up to %g C' % (result.path, result.duration / 3600.0,
+                                         rate_text(result.heat_rate), result.hold / 60,
+                                         result.peak, rate_text(result.cool_rate),
+                                         result.max_jump))
+    seconds = time.monotonic() - started
+    print('%d programs, %d flagged; %.1f MB in %.2f s, %.1f MB/s' % (
+        files, flagged, size / 1e6, seconds, size / 1e6 / max(seconds, 1e-9)), file=sys.stderr)
+    return 1 if flagged else 0
+
+
+def cmd_resume(args, parser):
+    from .resume import write_resume
+
+    if (args.elapsed is None) == (args.bed is None):
+        parser.error('give one of --elapsed and --bed')
+    if args.bed is not None and not args.phase:
+        parser.error('--bed needs --phase')
+    rows = job_rows(args, parser)
+    if len(rows) != 1:
+        parser.error('resume takes one job')
+    job = make_job(rows[0], presets_arg(args))
+    elapsed = None if args.elapsed is None else args.elapsed * 60
+    path = '-'
+    if args.out_dir != '-':
+        os.makedirs(args.out_dir, exist_ok=True)
+        name = file_name(*job_args(job)[:5]) + '_resume_%s' % (
+            '%dmin' % args.elapsed if args.bed is None else '%s_%gC' % (args.phase, args.bed))
+        path = os.path.join(args.out_dir, name + '.gcode')
+    written = write_resume(path, *job_args(job), elapsed=elapsed, temp=args.bed,
+                           phase=args.phase, compact=args.compact, exact=args.exact,
+                           step=args.step, commands=args.commands)
+    print('%s (%d lines, %d bytes)' % (path, written.lines, written.size),
+          file=sys.stderr if path == '-' else sys.stdout)
+    return 0
+
+
+def cmd_profile(args, parser):
+    from .profile import compile_stages, load_profile, write_profile
+
+    material, ambient, stages = load_profile(args.file)
+    path = '-'
+    if args.out_dir != '-':
+        os.makedirs(args.out_dir, exist_ok=True)
+        name = '%s_profile_%s' % (material, os.path.splitext(os.path.basename(args.file))[0])
+        path = os.path.join(args.out_dir, name + ('.gcode.gz' if args.gzip else '.gcode'))
+    written = write_profile(path, material, stages, ambient, args.gzip,
+                            compact=args.compact, step=args.step,
+                            **chamber_options(args, parser))
+    minutes = sum(segment.minutes for segment in compile_stages(stages, ambient, args.step))
+    print('%s (%d lines, %d bytes), %.1f hours' % (path, written.lines, written.size,
+                                                   minutes / 60),
+          file=sys.stderr if path == '-' else sys.stdout)
+    return 0
+
+
+def cmd_index(args, parser):
+    from .resume import write_offsets
+
+    for path in args.paths:
+        print(write_offsets(path))
+    return 0
+
+
+def cmd_klipper_macros(args, parser):
+    sys.stdout.write(KLIPPER_MACROS)
+    return 0
+
+
+def cmd_fakemarlin(args, parser):
+    from .fakemarlin import serve
+
+    try:
+        asyncio.run(serve(args.speedup, args.error_rate))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_serve(args, parser):
+    from .server import AnnealServer
+
+    if args.cache_entries < 0 or args.cache_size < 0:
+        parser.error('--cache-entries and --cache-size must be 0 or more')
+    server = AnnealServer(presets_arg(args), args.cache_entries,
+                          int(args.cache_size * 1024 * 1024))
+    print('serving on http://%s:%d/anneal' % (args.host, args.port), file=sys.stderr)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_loadtest(args, parser):
+    from .loadtest import percentile, run
+
+    result = asyncio.run(run(args.url, args.concurrency, args.requests, args.distinct))
+    print('%d requests, %d errors in %.2f s: %.0f req/s, %.1f MB/s' % (
+        result.requests, result.errors, result.seconds, result.requests / result.seconds,
+        result.bytes / 1e6 / result.seconds))
+    print('latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % tuple(
+        1000 * percentile(result.latencies, fraction) for fraction in (0.5, 0.9, 0.99, 1)))
+    return 1 if result.errors else 0
+
+
+def cmd_bench(args, parser):
+    from . import bench
+
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes one or two files')
+    modes = tuple(args.mode or bench.MODES)
+    unknown = set(modes) - set(bench.MODES)
+    if unknown:
+        parser.error('unknown mode(s) %s, use %s' % (', '.join(sorted(unknown)),
+                                                     ', '.join(bench.MODES)))
+    if args.compare and len(args.compare) == 2:
+        report = bench.load(args.compare[1])
+    else:
+        def progress(result):
+            if 'case' in result:
+                print('%-11s %-10s %8d lines %9d bytes %10.0f lines/s %7.1f MB/s'
+                      '  peak %7.1f KB' % (
+                          result['case'], result['mode'], result['lines'], result['bytes'],
+                          result['lines_per_sec'], result['bytes_per_sec'] / 1e6,
+                          result['peak_memory'] / 1024.0))
+            else:
+                print('batch of %d jobs, %d workers: %.2f s, %.0f jobs/s, %.1f MB/s' % (
+                    result['jobs'], result['workers'], result['seconds'],
+                    result['jobs_per_sec'], result['bytes_per_sec'] / 1e6))
+
+        rounds, min_time = (1, 0.02) if args.quick else (bench.ROUNDS, bench.MIN_TIME)
+        report = bench.run(modes=modes, rounds=rounds, min_time=min_time, batch=args.batch,
+                           workers=args.workers, progress=progress)
+        if args.output:
+            bench.save(report, args.output)
+    if not args.compare:
+        return 0
+    lines, regressed = bench.compare(bench.load(args.compare[0]), report,
+                                     args.threshold / 100.0)
+    print('\n'.join(lines))
+    return 1 if regressed else 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args, parser)
+    except (ImportError, OSError, ValueError) as err:
+        print('ikneel: error: %s' % err, file=sys.stderr)
+        return 1
@@ -0,0 +1,124 @@
+"""
+Closed loop anneal: run the cycle from the host, watching the bed.
+
+A program written ahead of time has to assume where the bed starts
+(AMBIENT) and that it follows every setpoint, so its G4 dwells are fixed.
+Here the host drives the printer step by step instead and reads the bed
+with M105:
+
+- the heating ramp starts from the measured bed temperature, so a bed
+  still warm from the last job does not sit through degrees it already has
+- after each ramp step the host reads how far the bed trails the setpoint
+  (the lag) and corrects the next dwell by gain times the change in lag
+  since the step before, in degrees' worth of ramp time. A first order
+  bed settles to a steady lag of about rate * tau whatever its time
+  constant, and that alone costs nothing: only a bed falling further
+  behind (a heater that cannot keep up) gets longer dwells, and one
+  catching up gets shorter ones, down to min_dwell times the open loop
+  dwell; max_dwell caps the stretch.
+- the soak does not start counting until the bed is within tolerance of
+  the anneal temperature
+
+The steps themselves come from the schedule engine, so exact=True and
+step work as they do for written programs.
+"""
+
+from collections import namedtuple
+
+from .gcode import AMBIENT, COOL_STEP, FOOTER, HEAT_START, COOL_START, HEAT_STEP_COMPACT, \
+    SOAK_STEP
+from .schedule import format_temp, hold, plan, ramp
+
+# Dwell added per degree the lag grew over the last step, in degrees of
+# ramp time; negative when it shrank
+GAIN = 1.0
+# Limits on a dwell, as fractions of the open loop dwell
+MIN_DWELL = 0.5
+MAX_DWELL = 3.0
+# Degrees C below the anneal temperature that count as reached for the soak
+TOLERANCE = 1.0
+# Seconds between bed readings while waiting for the soak temperature,
+# and the most minutes to wait before soaking anyway
+POLL = 30
+SETTLE = 60
+
+# start is the measured bed temperature the ramp began from, seconds the
+# dwell time actually run against nominal for the open loop program, and
+# max_lag the most the bed trailed a ramp setpoint, deg C.
+LoopStats = namedtuple('LoopStats', 'start seconds nominal steps max_lag settled')
+
+
+async def bed_temp(sender):
+    """The bed temperature from an M105, deg C"""
+    await sender.command('M105')
+    if 'B' not in sender.temps:
+        raise ConnectionError('printer did not report a bed temperature')
+    return sender.temps['B'][0]
+
+
+def lines(template, *values):
+    return (template % values).splitlines()
+
+
+async def anneal(sender, anneal_temp, heat_rate, soak_time, cool_rate, ambient=AMBIENT,
+                 gain=GAIN, min_dwell=MIN_DWELL, max_dwell=MAX_DWELL,
+                 tolerance=TOLERANCE, poll=POLL, settle=SETTLE, progress=None,
+                 exact=False, step=1, commands=None):
+    """Run one anneal cycle on a connected host.MarlinSender
+
+    Cooling ends at ambient as in a written program. progress(phase,
+    setpoint, bed) is called after each bed reading. Returns LoopStats.
+    """
+    start = await bed_temp(sender)
+    if start >= anneal_temp - tolerance:
+        raise ValueError('bed is already at %.1f C, not below the anneal temperature %d'
+                         % (start, anneal_temp))
+    segments = [ramp('heat', int(round(start)), anneal_temp, heat_rate),
+                hold('soak', anneal_temp, soak_time),
+                ramp('cool', anneal_temp, ambient, cool_rate)]
+    (heat, heat_steps), (soak, soak_steps), (cool, cool_steps) = \
+        plan(segments, exact, step, commands)
+    seconds = nominal = 0
+    max_lag = 0.0
+
+    async def run_ramp(segment, steps, template, sign):
+        nonlocal seconds, nominal, max_lag
+        # The bed starts at the first setpoint, or follows it from the soak
+        lag = previous = 0.0
+        for item in steps:
+            dwell = item.dwell + gain * (lag - previous) * 3600.0 / segment.rate
+            dwell = int(round(min(max(dwell, min_dwell * item.dwell), max_dwell * item.dwell)))
+            await sender.send(lines(template, format_temp(item.setpoint), dwell, item.remaining))
+            seconds += dwell
+            nominal += item.dwell
+            bed = await bed_temp(sender)
+            previous, lag = lag, sign * (item.setpoint - bed)
+            max_lag = max(max_lag, lag)
+            if progress:
+                progress(segment.phase, item.setpoint, bed)
+
+    await sender.send([HEAT_START.strip()])
+    await run_ramp(heat, heat_steps, HEAT_STEP_COMPACT, 1)
+
+    # Wait for the bed to get there before counting the soak
+    waited = 0
+    bed = await bed_temp(sender)
+    while bed < anneal_temp - tolerance and waited < settle * 60:
+        await sender.send(['G4 S%d' % poll])
+        waited += poll
+        bed = await bed_temp(sender)
+        if progress:
+            progress('soak', anneal_temp, bed)
+    seconds += waited
+    program = []
+    for item in soak_steps:
+        program += lines(SOAK_STEP, item.dwell, item.remaining)
+        seconds += item.dwell
+        nominal += item.dwell
+    await sender.send(program)
+
+    await sender.send([COOL_START.strip()])
+    await run_ramp(cool, cool_steps, COOL_STEP, -1)
+    await sender.send(FOOTER.splitlines())
+    return LoopStats(start, seconds, nominal, len(heat_steps) + len(cool_steps), max_lag,
+                     bed >= anneal_temp - tolerance)
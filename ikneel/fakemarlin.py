@@ -0,0 +1,230 @@
+"""
+A fake Marlin printer on a pty, for trying the serial host without a printer.
+
+It speaks enough of Marlin's serial protocol for anneal programs: line
+numbers and checksums with Error / Resend / ok, M110, M140 and M105 against
+a simple bed model, G4 with busy keepalives, M117, M141 (the chamber
+setpoint is only recorded) and the odd command that is just acknowledged.
+Time runs speedup times faster than the wall clock, so a 10 hour cycle at
+speedup=3600 takes 10 seconds.
+
+    python -m ikneel fakemarlin --speedup 600
+
+prints the pty to point a host at. error_rate makes that fraction of the
+lines arrive "damaged" so resends can be exercised.
+"""
+
+import asyncio
+import math
+import os
+import random
+import re
+import tty
+
+from .host import SerialPort, checksum
+
+# Marlin's command buffer, BUFSIZE
+BUFSIZE = 4
+# Real seconds between busy keepalives while a command runs
+KEEPALIVE = 2.0
+
+LINE = re.compile(r'^N(\d+)\s+(.*)\*(\d+)$')
+WORD = re.compile(r'([A-Z])(-?\d+(?:\.\d*)?)')
+
+
+class Bed:
+    """First order heat bed: approaches its target with time constant tau
+
+    max_rate, deg C per second, limits how fast the heater can warm it.
+    With the heater off (target 0) it cools towards ambient. temp is where
+    it starts, ambient by default, e.g. still warm from the last job.
+    """
+
+    def __init__(self, ambient=22.0, tau=120.0, max_rate=None, temp=None):
+        self.ambient = ambient
+        self.tau = tau
+        self.max_rate = max_rate
+        self.temp = ambient if temp is None else temp
+        self.target = 0.0
+        self.time = 0.0
+
+    def advance(self, now):
+        """Move the bed model on to sim time now, seconds"""
+        dt = now - self.time
+        if dt <= 0:
+            return self.temp
+        goal = self.target if self.target > 0 else self.ambient
+        temp = goal + (self.temp - goal) * math.exp(-dt / self.tau)
+        if self.max_rate and temp > self.temp:
+            temp = min(temp, self.temp + self.max_rate * dt)
+        self.temp = temp
+        self.time = now
+        return temp
+
+
+class FakeMarlin:
+    """A simulated printer listening on a pty, see the module docstring"""
+
+    def __init__(self, speedup=1.0, bufsize=BUFSIZE, error_rate=0.0, seed=None,
+                 keepalive=KEEPALIVE, bed=None, boot=0):
+        self.speedup = speedup
+        self.bufsize = bufsize
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.keepalive = keepalive
+        self.bed = bed or Bed()
+        # Wall seconds spent in the bootloader after start(), as a board
+        # that resets when the port opens; lines sent then are lost
+        self.boot = boot
+        self._booting = False
+        # Last M141 setpoint, deg C
+        self.chamber = 0.0
+        self.path = None
+        self.last_number = 0
+        # What the printer showed, as (sim seconds, text)
+        self.displays = []
+        # Commands run, as (sim seconds, command)
+        self.log = []
+        self.errors = 0
+        self._tasks = []
+        self._slave = None
+        self._port = None
+        self._started = None
+
+    @property
+    def display(self):
+        return self.displays[-1][1] if self.displays else ''
+
+    def clock(self):
+        """Sim seconds since start()"""
+        return (asyncio.get_running_loop().time() - self._started) * self.speedup
+
+    async def start(self):
+        """Open the pty and start answering, returning the path for the host"""
+        master, self._slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(self._slave)
+        os.set_blocking(master, False)
+        self.path = os.ttyname(self._slave)
+        self._port = await SerialPort(master).connect()
+        self._started = asyncio.get_running_loop().time()
+        queue = asyncio.Queue(self.bufsize)
+        self._tasks = [asyncio.ensure_future(self._receive(queue)),
+                       asyncio.ensure_future(self._run(queue))]
+        if self.boot:
+            self._booting = True
+            self._tasks.append(asyncio.ensure_future(self._boot()))
+        return self.path
+
+    async def _boot(self):
+        await asyncio.sleep(self.boot)
+        self._booting = False
+        self._say('start')
+        await self._port.drain()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._port:
+            self._port.close()
+            self._port = None
+        if self._slave is not None:
+            os.close(self._slave)
+            self._slave = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def _say(self, text):
+        self._port.write(text + '\n')
+
+    def _reject(self, message):
+        self.errors += 1
+        self._say('Error:' + message)
+        self._say('Resend: %d' % (self.last_number + 1))
+        self._say('ok')
+
+    async def _receive(self, queue):
+        """Check incoming lines and queue the good ones, like GCodeQueue"""
+        while True:
+            line = await self._port.readline()
+            if line is None:
+                return
+            if not line or self._booting:
+                continue
+            match = LINE.match(line)
+            if not line.startswith('N'):
+                command = line
+            elif not match:
+                self._reject('No Checksum with line number, Last Line: %d' % self.last_number)
+                continue
+            else:
+                number, command, check = int(match.group(1)), match.group(2), int(match.group(3))
+                if self.error_rate and self.random.random() < self.error_rate:
+                    check ^= 0x55
+                if number != self.last_number + 1 and not command.startswith('M110'):
+                    self._reject('Line Number is not Last Line Number+1, Last Line: %d'
+                                 % self.last_number)
+                    continue
+                if check != checksum(line[:line.rindex('*')]):
+                    self._reject('checksum mismatch, Last Line: %d' % self.last_number)
+                    continue
+                self.last_number = number
+            if command.startswith('M110'):
+                words = dict(WORD.findall(command[4:]))
+                self.last_number = int(float(words.get('N', 0)))
+            await queue.put(command)
+
+    async def _run(self, queue):
+        """Run queued commands in order, answering ok after each"""
+        while True:
+            command = await queue.get()
+            self.log.append((self.clock(), command))
+            reply = await self.execute(command)
+            self._say(reply)
+            await self._port.drain()
+
+    async def execute(self, command):
+        """Carry out one command, returning the ok line"""
+        code = command.split(None, 1)[0].upper()
+        words = dict(WORD.findall(command[len(code):].upper()))
+        if code == 'G4':
+            seconds = float(words.get('S', 0)) + float(words.get('P', 0)) / 1000
+            await self._dwell(seconds)
+        elif code == 'M140':
+            self.bed.advance(self.clock())
+            self.bed.target = float(words.get('S', 0))
+        elif code == 'M105':
+            temp = self.bed.advance(self.clock())
+            return 'ok T:0.00 /0.00 B:%.2f /%.2f' % (temp, self.bed.target)
+        elif code == 'M141':
+            self.chamber = float(words.get('S', 0))
+        elif code == 'M117':
+            self.displays.append((self.clock(), command[4:].strip()))
+        elif code not in ('M84', 'M104', 'M110', 'M18'):
+            self._say('echo:Unknown command: "%s"' % command)
+        return 'ok'
+
+    async def _dwell(self, seconds):
+        """Sleep seconds of sim time, sending busy keepalives like Marlin"""
+        end = asyncio.get_running_loop().time() + seconds / self.speedup
+        while True:
+            left = end - asyncio.get_running_loop().time()
+            if left <= 0:
+                return
+            await asyncio.sleep(min(left, self.keepalive))
+            if end - asyncio.get_running_loop().time() > 0:
+                self._say('echo:busy: processing')
+
+
+async def serve(speedup=1.0, error_rate=0.0):
+    """Run a FakeMarlin until cancelled, printing its pty"""
+    async with FakeMarlin(speedup, error_rate=error_rate) as printer:
+        print(printer.path, flush=True)
+        await asyncio.Event().wait()
@@ -0,0 +1,129 @@
+"""
+Loop output for firmware that can run loops itself.
+
+Marlin needs every ramp step and soak minute written out, so a program
+grows with the anneal range and the soak time. RepRapFirmware 3 has
+while loops and Klipper has Jinja macros, so for those each segment of
+the schedule becomes one small loop and the program stays a few dozen
+lines whatever the cycle.
+
+rrf      a while loop per segment, using the iterations counter
+klipper  a call per segment to the ANNEAL_RAMP / ANNEAL_HOLD macros in
+         KLIPPER_MACROS, which go in printer.cfg once
+
+Both follow the exact schedule (see schedule.exact_steps): each dwell
+ends on the whole second nearest the exact time, so the ramps take as
+long as the rates say.
+"""
+
+import math
+
+from . import metrics
+
+FIRMWARES = ('marlin', 'rrf', 'klipper')
+
+LABELS = {'heat': 'Heating', 'soak': 'Soak', 'cool': 'Cooling'}
+
+LOOP_NOTE = '; %s loops, drift free timing, %s deg C steps\n'
+
+# RRF wants M117 text quoted and uses ^ to join strings
+RRF_HEAT_START = 'M117 "Ramping temp up"\n'
+RRF_COOL_START = 'M117 "Ramping temp down"\n'
+RRF_RAMP = (
+    '; %(start)s to %(end)s deg C in %(count)d steps over %(seconds)d seconds\n'
+    'while iterations < %(count)d\n'
+    '  M140 S{%(start)s %(sign)s %(span)s * (iterations + 1) / %(count)d}\n'
+    '  G4 S{floor(%(seconds)d * (iterations + 1) / %(count)d + 0.5)'
+    ' - floor(%(seconds)d * iterations / %(count)d + 0.5)}\n'
+    '  M117 {"%(label)s " ^ floor(%(seconds)d * (%(count)d - iterations - 1)'
+    ' / %(count)d / 60 + 0.5) ^ " more min"}\n'
+)
+RRF_HOLD = (
+    '; hold for %(seconds)d seconds\n'
+    'while iterations < %(count)d\n'
+    '  G4 S{min(60, %(seconds)d - 60 * iterations)}\n'
+    '  M117 {"%(label)s " ^ (%(count)d - iterations - 1) ^ " more min"}\n'
+)
+RRF_FOOTER = 'M140 S0  ; Turn OFF bed heater\nM117 "Done!"\n'
+
+# Klipper's G4 only takes P, milliseconds
+KLIPPER_MACROS = '''\
+# iKneel anneal macros, add to printer.cfg
+[gcode_macro ANNEAL_RAMP]
+description: Ramp the bed from START to END deg C in STEPS steps over SECONDS
+gcode:
+  {% set start = params.START|float %}
+  {% set span = params.END|float - start %}
+  {% set ms = params.SECONDS|int * 1000 %}
+  {% set count = params.STEPS|int %}
+  {% set label = params.LABEL|default("Ramping") %}
+  {% for k in range(1, count + 1) %}
+    M140 S{"%.2f" % (start + span * k / count)}
+    G4 P{(ms * k / count)|round|int - (ms * (k - 1) / count)|round|int}
+    M117 {label} {(ms * (count - k) / count / 60000)|round|int} more min
+  {% endfor %}
+
+[gcode_macro ANNEAL_HOLD]
+description: Keep the bed setpoint for SECONDS, counting down the minutes
+gcode:
+  {% set seconds = params.SECONDS|int %}
+  {% set count = ((seconds + 59) / 60)|int %}
+  {% set label = params.LABEL|default("Soak") %}
+  {% for k in range(count) %}
+    G4 P{([60, seconds - 60 * k]|min) * 1000}
+    M117 {label} {count - k - 1} more min
+  {% endfor %}
+'''
+KLIPPER_NOTE = '; Needs the ANNEAL_RAMP and ANNEAL_HOLD macros: python -m ikneel klipper-macros\n'
+KLIPPER_RAMP = 'ANNEAL_RAMP START=%(start)s END=%(end)s STEPS=%(count)d SECONDS=%(seconds)d' \
+    ' LABEL=%(label)s\n'
+KLIPPER_HOLD = 'ANNEAL_HOLD SECONDS=%(seconds)d LABEL=%(label)s\n'
+KLIPPER_FOOTER = 'M140 S0  ; Turn OFF bed heater\nM117 Done!\n'
+
+
+def number(value):
+    """A temperature or span without a needless .0"""
+    return '%d' % value if value == int(value) else '%.10g' % value
+
+
+def loop_values(segment, step=1):
+    """The values the loop templates are filled with for one segment"""
+    seconds = int(round(segment.minutes * 60))
+    if segment.rate is None:
+        count = max(1, math.ceil(seconds / 60.0))
+    else:
+        if step <= 0:
+            raise ValueError('step must be above 0 deg C, got %r' % step)
+        count = max(1, math.ceil(abs(segment.end - segment.start) / step - 1e-9))
+    return {'start': number(segment.start), 'end': number(segment.end),
+            'sign': '-' if segment.end < segment.start else '+',
+            'span': number(abs(segment.end - segment.start)), 'count': count,
+            'seconds': seconds, 'label': LABELS.get(segment.phase, segment.phase.title())}
+
+
+def iter_loops(firmware, segments, step=1):
+    """Yield the body of a program, after the header, as one loop per segment"""
+    if firmware not in FIRMWARES[1:]:
+        raise ValueError('no loop output for firmware %r, use one of %s'
+                         % (firmware, ', '.join(FIRMWARES[1:])))
+    rrf = firmware == 'rrf'
+    yield LOOP_NOTE % ('RepRapFirmware' if rrf else 'Klipper macro', number(step))
+    if not rrf:
+        yield KLIPPER_NOTE
+    phase = None
+    for segment in segments:
+        if segment.phase != phase:
+            metrics.phase(segment.phase)
+        if segment.phase != phase and segment.phase in ('heat', 'cool'):
+            if rrf:
+                yield RRF_HEAT_START if segment.phase == 'heat' else RRF_COOL_START
+            else:
+                yield 'M117 Ramping temp %s\n' % ('up' if segment.phase == 'heat' else 'down')
+        phase = segment.phase
+        values = loop_values(segment, step)
+        if segment.rate is None:
+            yield (RRF_HOLD if rrf else KLIPPER_HOLD) % values
+        else:
+            yield (RRF_RAMP if rrf else KLIPPER_RAMP) % values
+    metrics.phase('footer')
+    yield RRF_FOOTER if rrf else KLIPPER_FOOTER
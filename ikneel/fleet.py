@@ -0,0 +1,182 @@
+"""
+Run a queue of anneal jobs on a rack of printers at once.
+
+Jobs wait in one queue and each printer takes the next as soon as it is
+idle, all from one asyncio event loop: a printer in the middle of a
+soak is only an open port waiting for its next ok, so any number of them
+can be driven from one thread.
+
+    fleet = Fleet(['/dev/ttyUSB0', '/dev/ttyUSB1'])
+    results = asyncio.run(fleet.run(jobs, report=print_status))
+
+status() gives each printer's progress and estimated time left, and
+estimate() the time until the whole queue is done. A printer that stops
+answering is taken out of the rack; its job is reported as failed rather
+than started again elsewhere, as the part is still on that printer.
+
+simulated() starts fake printers (see fakemarlin.py) with clocks running
+speedup times faster, to try a rack without one.
+"""
+
+import asyncio
+import heapq
+import os
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+from . import host
+from .batch import job_args
+from .gcode import generate_anneal
+
+# One job's outcome; stats is the host.SendStats, or None and error is set
+FleetResult = namedtuple('FleetResult', 'index job printer stats error')
+# state is idle, busy or offline; remaining is wall seconds left on the job
+PrinterStatus = namedtuple('PrinterStatus', 'name state job done total remaining')
+
+
+def program_seconds(lines):
+    """Dwell seconds in a program, how long it keeps the printer busy"""
+    return sum(host.dwell_seconds(command) for command in host.commands(lines))
+
+
+class _Printer:
+    """One printer's progress through its current job"""
+
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.state = 'idle'
+        self.error = None
+        self.job = None
+        self.done = self.total = 0
+        self.seconds = self.run_seconds = 0.0
+
+    def start(self, job, total, seconds):
+        self.state = 'busy'
+        self.job = job
+        self.done, self.total = 0, total
+        self.seconds, self.run_seconds = seconds, 0.0
+
+    def progress(self, done, total, run_seconds):
+        self.done = done
+        self.run_seconds = run_seconds
+
+    def finish(self):
+        self.state = 'idle'
+        self.job = None
+        self.seconds = self.run_seconds = 0.0
+
+
+class Fleet:
+    """Printers on ports, fed from one queue of batch job dicts
+
+    options are passed on to generate_anneal for every job; time_scale is
+    as for host.MarlinSender.
+    """
+
+    def __init__(self, ports, names=None, baud=115200, window=host.WINDOW,
+                 timeout=host.TIMEOUT, time_scale=1.0, **options):
+        names = names or [os.path.basename(port) for port in ports]
+        self.printers = [_Printer(name, port) for name, port in zip(names, ports)]
+        self.baud = baud
+        self.window = window
+        self.timeout = timeout
+        self.time_scale = time_scale
+        self.options = options
+        # Program seconds of the jobs still waiting, in queue order
+        self._waiting = {}
+
+    def status(self):
+        """A PrinterStatus for each printer"""
+        return [PrinterStatus(printer.name, printer.state, printer.job, printer.done,
+                              printer.total,
+                              (printer.seconds - printer.run_seconds) * self.time_scale)
+                for printer in self.printers]
+
+    def estimate(self):
+        """Wall seconds until every queued job is done, None with no printers left
+
+        Hands the waiting jobs out in order to whichever printer frees up
+        first, the way the queue will.
+        """
+        free = [(printer.seconds - printer.run_seconds) * self.time_scale
+                for printer in self.printers if printer.state != 'offline']
+        if not free:
+            return None
+        heapq.heapify(free)
+        for seconds in self._waiting.values():
+            heapq.heapreplace(free, free[0] + seconds * self.time_scale)
+        return max(free)
+
+    async def run(self, jobs, report=None, interval=10):
+        """Run every job, returning a FleetResult for each in job order
+
+        report(fleet) is called every interval seconds while jobs run.
+        """
+        queue = asyncio.Queue()
+        programs = []
+        for index, job in enumerate(jobs):
+            program = list(host.commands(
+                generate_anneal(*job_args(job), **self.options).splitlines()))
+            programs.append(program)
+            self._waiting[index] = program_seconds(program)
+            queue.put_nowait((index, job))
+        results = [None] * len(jobs)
+        reporter = None
+        if report:
+            reporter = asyncio.ensure_future(self._report(report, interval))
+        try:
+            await asyncio.gather(*(self._work(printer, queue, programs, results)
+                                   for printer in self.printers))
+        finally:
+            if reporter:
+                reporter.cancel()
+        for index, job in enumerate(jobs):
+            if results[index] is None:
+                results[index] = FleetResult(index, job, None, None, 'no printer left to run it')
+        self._waiting.clear()
+        return results
+
+    async def _report(self, report, interval):
+        while True:
+            await asyncio.sleep(interval)
+            report(self)
+
+    async def _work(self, printer, queue, programs, results):
+        try:
+            sender = await host.connect(printer.port, self.baud, self.window,
+                                        self.timeout, self.time_scale)
+        except (OSError, ValueError) as err:
+            # Not there, not a tty or cannot take the baud rate
+            printer.state, printer.error = 'offline', str(err)
+            return
+        try:
+            while not queue.empty():
+                index, job = queue.get_nowait()
+                program = programs[index]
+                printer.start(job, len(program), self._waiting.pop(index))
+                try:
+                    stats = await sender.send(program, printer.progress)
+                except OSError as err:
+                    printer.state, printer.error = 'offline', str(err)
+                    results[index] = FleetResult(index, job, printer.name, None, str(err))
+                    return
+                results[index] = FleetResult(index, job, printer.name, stats, None)
+                printer.finish()
+        finally:
+            sender.close()
+
+
+@asynccontextmanager
+async def simulated(count, speedup=60.0, **fake_options):
+    """Start count fake printers, giving the list of FakeMarlins"""
+    from .fakemarlin import FakeMarlin
+
+    printers = [FakeMarlin(speedup, **fake_options) for _ in range(count)]
+    try:
+        for printer in printers:
+            await printer.start()
+        yield printers
+    finally:
+        for printer in printers:
+            await printer.stop()
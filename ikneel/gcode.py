@@ -0,0 +1,318 @@
+"""
+Gcode generation for using a 3D printers heat bed as an annealing oven.
+
+This is the heat / soak / cool sequence the interactive script has always
+written, moved into functions so it can be imported and driven by a job
+system without answering prompts.
+
+The steps come from the schedule engine. By default they are cut the way
+version 2.02 cut them, so programs come out byte for byte the same;
+exact=True gives drift free timing and step sizes other than one degree.
+
+Compact output (compact=N minutes) only updates the display every N
+minutes. Soak minutes are merged into one G4 per update and the ramps
+drop the M117 between updates, which takes a long PETG program from
+thousands of lines to a few hundred.
+
+firmware='rrf' or 'klipper' writes each segment as a loop run by the
+firmware instead, a few dozen lines in all; see firmware.py. Marlin, the
+default, has no loops.
+
+chamber_offset drives an enclosure heater as well, with M141 following
+the bed setpoint by chamber_offset deg C and chamber_lag minutes (see
+schedule.link_chamber), so the air in the box keeps up with the bed.
+"""
+
+from itertools import groupby
+
+from . import metrics
+from .firmware import FIRMWARES, iter_loops
+from .schedule import CHAMBER_MAX, anneal_segments, check_chamber, format_temp, link_chamber, \
+    plan
+from .writer import BUFFER_SIZE, measure, open_output, write_records
+
+# Default ambient temperature, deg C
+# was 21, need to think about this
+AMBIENT = 27
+
+# Ranges accepted by the interactive prompts, (minimum, maximum)
+LIMITS = {
+    'anneal_temp': (50, 120),
+    'heat_rate': (11, 28),
+    'soak_time': (6, 999),
+    'cool_rate': (6, 28),
+}
+
+
+def check_params(anneal_temp, heat_rate, soak_time, cool_rate, ambient=AMBIENT):
+    """Raise ValueError unless every parameter is a whole number in range"""
+    values = {
+        'anneal_temp': anneal_temp,
+        'heat_rate': heat_rate,
+        'soak_time': soak_time,
+        'cool_rate': cool_rate,
+        'ambient': ambient,
+    }
+    for name, value in values.items():
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError('%s must be a whole number, got %r' % (name, value))
+        if name in LIMITS:
+            minimum, maximum = LIMITS[name]
+            if not minimum <= value <= maximum:
+                raise ValueError('%s must be %d to %d, got %d'
+                                 % (name, minimum, maximum, value))
+    if ambient >= anneal_temp:
+        raise ValueError('ambient (%d) must be below anneal_temp (%d)'
+                         % (ambient, anneal_temp))
+
+
+def file_name(material, anneal_temp, heat_rate, soak_time, cool_rate):
+    """Build the file name, without extension, that encodes the parameters"""
+    return (material + '_anneal_' + str(anneal_temp) + '_' + str(heat_rate)
+            + '_' + str(soak_time) + '_' + str(cool_rate))
+
+
+# Display update intervals tried, in minutes, when fitting a line or size budget
+COMPACT_STEPS = (1, 2, 5, 10, 15, 20, 30, 60, 120, 240, 480, 999)
+
+
+# Line templates, filled with % so no line is built up by concatenation
+HEADER = (
+    '; gcode to control heat bed to anneal printed parts\n'
+    '; Material is: %s\n'
+    '; Annealing holding temperature is: %s deg C\n'
+    '; Heating will take: %s minutes (%s hours)\n'
+    '; Heating rate is: %s deg C per hour\n'
+    '; Hold at annealing temperature for: %sminutes\n'
+    '; Cooling rate is: %s deg C per hour\n'
+    '; Cooling will take: %s minutes (%s hours)\n'
+    '; Ambient temperature is assumed to be 21 deg C (70 deg F)\n'
+    '; \n'
+    # Disable motors, they are not needed and make sure extruder is off
+    'M84 ; Make sure motors are OFF\n'
+    'M104 S0 ; Make sure extruder is OFF\n'
+    '; \n'
+)
+COMPACT_NOTE = '; Compact output, display updated every %d minutes\n'
+EXACT_NOTE = '; Drift free timing, %d heating and %d cooling steps\n'
+HEAT_START = 'M117 Ramping temp up\n'
+# G4 displays Sleep.... during the dwell, and the M117 does not show until AFTER it
+HEAT_STEP = ('M140 S%s ; Raise bed temp to next higher to ramp smoothly\n'
+             'G4 S%d ; and pause x seconds to meet defined rate\n'
+             'M117 Heating %d more min\n')
+# Compact output leaves the comments off the ramp lines
+HEAT_STEP_COMPACT = 'M140 S%s\nG4 S%d\nM117 Heating %d more min\n'
+SOAK_STEP = 'G4 S%d\nM117 Soak %d more min\n'
+COOL_START = 'M117 Ramping temp down\n'
+COOL_STEP = 'M140 S%s\nG4 S%d\nM117 Cooling %d more min\n'
+RAMP_HOLD = 'M140 S%s\nG4 S%d\n'
+FOOTER = 'M140 S0  ; Turn OFF bed heater\nM117 Done!\n'
+CHAMBER_NOTE = ('; Chamber heater (M141) follows the bed %s deg C, %s, up to %s deg C,'
+                ' peaking at %s deg C\n')
+CHAMBER_STEP = 'M141 S%s\n'
+# A merged soak dwell cut short by a chamber change
+CHAMBER_DWELL = 'G4 S%d\n'
+CHAMBER_OFF = 'M141 S0 ; Turn OFF chamber heater\n'
+# By phase: the display line opening it, the step template and the step
+# template for compact output
+PHASES = {
+    'heat': (HEAT_START, HEAT_STEP, HEAT_STEP_COMPACT),
+    'soak': ('', SOAK_STEP, SOAK_STEP),
+    'cool': (COOL_START, COOL_STEP, COOL_STEP),
+}
+
+
+def emit_steps(steps, show, update, chamber=False):
+    """Yield gcode for steps, showing the countdown at most every update seconds
+
+    show is the template with the display line. Steps that keep the
+    setpoint are merged into one G4 until the display is next due; the
+    others get RAMP_HOLD when the display is not due. The last step always
+    shows. chamber puts an M141 before each step that changes the chamber,
+    ending any merged dwell first.
+    """
+    shown = 0
+    dwell = 0
+    last = len(steps) - 1
+    for index, step in enumerate(steps):
+        if chamber and step.chamber is not None:
+            if dwell:
+                yield CHAMBER_DWELL % dwell
+                dwell = 0
+            yield CHAMBER_STEP % format_temp(step.chamber)
+        shown += step.dwell
+        due = shown >= update or index == last
+        if step.setpoint is None:
+            dwell += step.dwell
+            if due:
+                yield show % (dwell, step.remaining)
+                dwell = 0
+        elif due:
+            yield show % (format_temp(step.setpoint), step.dwell, step.remaining)
+        else:
+            yield RAMP_HOLD % (format_temp(step.setpoint), step.dwell)
+        if due:
+            shown = 0
+
+
+def chamber_note(planned, offset, lag, maximum):
+    """The header line describing the chamber channel of a linked plan"""
+    peak = max(step.chamber for _, steps in planned for step in steps
+               if step.chamber is not None)
+    if lag:
+        timing = '%g minutes %s' % (abs(lag), 'behind' if lag > 0 else 'ahead')
+    else:
+        timing = 'in step'
+    return CHAMBER_NOTE % ('%+g' % offset, timing, format_temp(maximum), format_temp(peak))
+
+
+def phase_steps(planned):
+    """The steps of consecutive segments of one phase as one list
+
+    Each step's remaining minutes take in the segments after its own, so
+    the countdown runs to the end of the phase.
+    """
+    steps = []
+    later = sum(segment.minutes for segment, _ in planned)
+    for segment, segment_steps in planned:
+        later -= segment.minutes
+        if later:
+            extra = int(round(later))
+            segment_steps = [step._replace(remaining=step.remaining + extra)
+                             for step in segment_steps]
+        steps.extend(segment_steps)
+    return steps
+
+
+def emit_plan(planned, compact=0, chamber=False):
+    """Yield gcode for planned (segment, steps), a phase at a time
+
+    Each run of segments of one phase gets that phase's opening display
+    line and step template from PHASES: ramp the temp up as specified,
+    hold at temperature counting down the minutes via display, ramp the
+    temp down as specified. chamber is for plans from link_chamber.
+    """
+    for phase, run in groupby(planned, key=lambda item: item[0].phase):
+        metrics.phase(phase)
+        start, template, compact_template = PHASES[phase]
+        if start:
+            yield start
+        yield from emit_steps(phase_steps(list(run)),
+                              compact_template if compact else template, compact * 60, chamber)
+
+
+def iter_anneal(material, anneal_temp, heat_rate, soak_time, cool_rate,
+                ambient=AMBIENT, compact=0, max_lines=None, max_bytes=None,
+                exact=False, step=1, commands=None, firmware='marlin',
+                chamber_offset=None, chamber_lag=0, chamber_max=CHAMBER_MAX):
+    """Yield the anneal program as records of one or more whole gcode lines
+
+    compact is the display update interval in minutes, 0 for the full
+    output. max_lines / max_bytes raise compact as far as needed to fit.
+    exact cuts the ramps into drift free steps of step deg C, or into
+    commands setpoint changes in all; see schedule.py. firmware is one of
+    FIRMWARES; the loop output only takes step. chamber_offset, if not
+    None, adds the chamber heater; see schedule.link_chamber.
+    """
+    check_params(anneal_temp, heat_rate, soak_time, cool_rate, ambient)
+    if compact < 0:
+        raise ValueError('compact must be 0 or more minutes, got %r' % compact)
+    if firmware not in FIRMWARES:
+        raise ValueError('firmware must be one of %s, got %r' % (', '.join(FIRMWARES), firmware))
+    chamber = chamber_offset is not None
+    if chamber:
+        check_chamber(chamber_offset, chamber_lag, chamber_max)
+    elif chamber_lag or chamber_max != CHAMBER_MAX:
+        raise ValueError('chamber_lag and chamber_max need a chamber_offset')
+    if firmware != 'marlin':
+        if chamber:
+            raise ValueError('the chamber heater is for Marlin output')
+        if compact or max_lines or max_bytes or commands:
+            raise ValueError('compact, max_lines, max_bytes and commands are for Marlin output;'
+                             ' %s output is already a few dozen lines' % firmware)
+        segments = anneal_segments(anneal_temp, heat_rate, soak_time, cool_rate, ambient)
+        metrics.phase('header')
+        yield HEADER % (material, anneal_temp, segments[0].minutes, segments[0].minutes/60,
+                        heat_rate, soak_time, cool_rate, segments[2].minutes,
+                        segments[2].minutes/60)
+        yield from iter_loops(firmware, segments, step)
+        return
+    if max_lines or max_bytes:
+        compact = fit_budget(material, anneal_temp, heat_rate, soak_time, cool_rate,
+                             ambient, compact, max_lines, max_bytes,
+                             exact=exact, step=step, commands=commands,
+                             chamber_offset=chamber_offset, chamber_lag=chamber_lag,
+                             chamber_max=chamber_max)
+
+    segments = anneal_segments(anneal_temp, heat_rate, soak_time, cool_rate, ambient)
+    planned = plan(segments, exact, step, commands)
+    if chamber:
+        planned = link_chamber(planned, chamber_offset, chamber_lag, chamber_max)
+    (heat, heat_steps), (soak, soak_steps), (cool, cool_steps) = planned
+    # How long will it take to ramp up to and down to at the specified rate, minutes
+    HeatTime = heat.minutes
+    CoolTime = cool.minutes
+
+    metrics.phase('header')
+    yield HEADER % (material, anneal_temp, HeatTime, HeatTime/60, heat_rate,
+                    soak_time, cool_rate, CoolTime, CoolTime/60)
+    if exact:
+        yield EXACT_NOTE % (len(heat_steps), len(cool_steps))
+    if chamber:
+        yield chamber_note(planned, chamber_offset, chamber_lag, chamber_max)
+    if compact:
+        yield COMPACT_NOTE % compact
+
+    yield from emit_plan(planned, compact, chamber)
+
+    # Turn off bed heater
+    metrics.phase('footer')
+    if chamber:
+        yield CHAMBER_OFF
+    yield FOOTER
+
+
+def fit_budget(material, anneal_temp, heat_rate, soak_time, cool_rate,
+               ambient=AMBIENT, compact=0, max_lines=None, max_bytes=None, **options):
+    """Return the smallest display interval, from compact up, whose output fits
+
+    Raises ValueError when even the longest interval does not fit, since the
+    ramps always need an M140 and a G4 for every step. options are the
+    schedule options of iter_anneal; exact with a larger step or fewer
+    commands gets below that floor.
+    """
+    candidates = [compact] + [step for step in COMPACT_STEPS if step > compact]
+    for interval in candidates:
+        size = measure(iter_anneal(material, anneal_temp, heat_rate, soak_time,
+                                   cool_rate, ambient, interval, **options))
+        if (not max_lines or size.lines <= max_lines) and \
+                (not max_bytes or size.size <= max_bytes):
+            return interval
+    raise ValueError('cannot fit in %s lines / %s bytes, the most compact output is'
+                     ' %d lines, %d bytes' % (max_lines or '-', max_bytes or '-',
+                                              size.lines, size.size))
+
+
+def generate_anneal(material, anneal_temp, heat_rate, soak_time, cool_rate,
+                    ambient=AMBIENT, **options):
+    """Return the whole anneal program as one string"""
+    return ''.join(iter_anneal(material, anneal_temp, heat_rate, soak_time,
+                               cool_rate, ambient, **options))
+
+
+def stream_anneal(fo, material, anneal_temp, heat_rate, soak_time, cool_rate,
+                  ambient=AMBIENT, buffer_size=BUFFER_SIZE, **options):
+    """Write the anneal program to an open text file, returning writer.Written"""
+    return write_records(iter_anneal(material, anneal_temp, heat_rate, soak_time,
+                                     cool_rate, ambient, **options), fo, buffer_size)
+
+
+def write_anneal(path, material, anneal_temp, heat_rate, soak_time, cool_rate,
+                 ambient=AMBIENT, compress=False, **options):
+    """Write the anneal program to path, '-' for stdout, gzipped if asked or *.gz
+
+    options are passed on to iter_anneal. Returns writer.Written.
+    """
+    with open_output(path, compress) as fo:
+        return stream_anneal(fo, material, anneal_temp, heat_rate, soak_time,
+                             cool_rate, ambient, **options)
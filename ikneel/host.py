@@ -0,0 +1,310 @@
+"""
+Stream a program to a Marlin printer over its serial port, instead of
+copying it to an SD card.
+
+Every line goes out numbered and checksummed, "N12 G4 S180*87". Marlin
+answers each line with ok once it has run it and asks for a line again with
+"Resend: 12" when one arrives damaged or out of order. Up to window lines
+are sent ahead of the oks, so the printer's command buffer never runs dry.
+
+A G4 keeps its ok back for the whole dwell. The sender just waits on the
+port during that time, using no CPU, and allows for the dwells it has
+sent before deciding the printer has gone quiet: the allowance is timeout
+seconds plus the dwell still in flight times time_scale (1 for a real
+printer, 1 / speedup for fakemarlin).
+
+Standard library only; the port is opened as a raw tty. Rates termios
+has no constant for, such as Marlin's default 250000, are set with the
+Linux termios2 ioctl.
+
+Many boards reset when the port is opened and miss what arrives while
+their bootloader runs, so reset() sends its M110 again until it is
+answered, straight away when the board announces itself with "start".
+"""
+
+import asyncio
+import fcntl
+import os
+import re
+import struct
+import sys
+import termios
+import time
+import tty
+from collections import namedtuple
+
+# Marlin's command buffer, BUFSIZE in Configuration_adv.h
+WINDOW = 4
+# Seconds of silence, beyond any dwell in flight, before giving up
+TIMEOUT = 30
+# Seconds to wait for the ok to an M110 before sending it again
+RESET_WAIT = 2
+
+# struct termios2 and its ioctls on Linux (the asm-generic values, which
+# x86 and ARM use), for baud rates termios has no B constant for
+TERMIOS2 = struct.Struct('=4I20s2I')
+TCGETS2 = 0x802C542A
+TCSETS2 = 0x402C542B
+CBAUD = 0o010017
+BOTHER = 0o010000
+IBSHIFT = 16
+
+TEMPS = re.compile(r'\b([TB]):\s*(-?[\d.]+)\s*/\s*(-?[\d.]+)')
+DWELL = re.compile(r'^G4\b.*?\bS(\d+(?:\.\d*)?)')
+
+SendStats = namedtuple('SendStats', 'lines resends seconds program_seconds')
+
+
+def checksum(text):
+    """Marlin's checksum: XOR of every byte before the *"""
+    result = 0
+    for byte in text.encode('ascii', 'replace'):
+        result ^= byte
+    return result
+
+
+def frame(number, command):
+    """The numbered, checksummed form of a command"""
+    text = 'N%d %s' % (number, command)
+    return '%s*%d\n' % (text, checksum(text))
+
+
+def commands(lines):
+    """Strip comments and blank lines from program text lines"""
+    for line in lines:
+        command = line.split(';', 1)[0].strip()
+        if command:
+            yield command
+
+
+def dwell_seconds(command):
+    """Seconds a command will keep the printer busy, for the timeout"""
+    match = DWELL.match(command)
+    return float(match.group(1)) if match else 0
+
+
+def set_baud(fd, baud):
+    """Set fd to baud, with termios2 on Linux when termios has no constant for it"""
+    speed = getattr(termios, 'B%d' % baud, None)
+    if speed is not None:
+        attrs = termios.tcgetattr(fd)
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        return
+    if not sys.platform.startswith('linux'):
+        raise ValueError('%d baud is only supported on Linux' % baud)
+    buf = bytearray(TERMIOS2.size)
+    fcntl.ioctl(fd, TCGETS2, buf)
+    iflag, oflag, cflag, lflag, cc, ispeed, ospeed = TERMIOS2.unpack(buf)
+    cflag = cflag & ~(CBAUD | CBAUD << IBSHIFT) | BOTHER | BOTHER << IBSHIFT
+    fcntl.ioctl(fd, TCSETS2, TERMIOS2.pack(iflag, oflag, cflag, lflag, cc, baud, baud))
+
+
+class SerialPort:
+    """Line based asyncio access to an open tty file descriptor"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.reader = None
+        self.transports = []
+
+    @classmethod
+    async def open(cls, path, baud=115200):
+        """Open a serial device or pty as a raw tty"""
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(fd)
+            set_baud(fd, baud)
+        except (termios.error, OSError, ValueError) as err:
+            os.close(fd)
+            raise ValueError('cannot set %s to %s baud: %s' % (path, baud, err))
+        return await cls(fd).connect()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.reader = asyncio.StreamReader(limit=1 << 16)
+        read, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.reader),
+            os.fdopen(self.fd, 'rb', buffering=0, closefd=False))
+        write, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, os.fdopen(self.fd, 'wb', buffering=0, closefd=False))
+        self.transports = [read, write]
+        self.writer = asyncio.StreamWriter(write, protocol, None, loop)
+        return self
+
+    async def readline(self):
+        """The next line without its line ending, None at end of file"""
+        try:
+            raw = await self.reader.readline()
+        except OSError:
+            # A pty reads EIO once the other side has closed
+            return None
+        if not raw:
+            return None
+        return raw.decode('ascii', 'replace').strip()
+
+    def write(self, text):
+        self.writer.write(text.encode('ascii', 'replace'))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MarlinSender:
+    """Send commands to a Marlin printer with ok flow control and resends"""
+
+    def __init__(self, port, window=WINDOW, timeout=TIMEOUT, time_scale=1.0):
+        self.port = port
+        self.window = window
+        self.timeout = timeout
+        self.time_scale = time_scale
+        self.number = 0
+        # Latest (current, target) from a temperature report, by 'T' / 'B'
+        self.temps = {}
+
+    async def _readline(self, allowance):
+        try:
+            line = await asyncio.wait_for(self.port.readline(), allowance)
+        except asyncio.TimeoutError:
+            raise TimeoutError('printer silent for %.0f seconds' % allowance)
+        if line is None:
+            raise ConnectionError('printer closed the port')
+        for name, current, target in TEMPS.findall(line):
+            self.temps[name] = (float(current), float(target))
+        return line
+
+    async def reset(self):
+        """Start line numbers again from 1 with M110
+
+        The M110 goes again every RESET_WAIT seconds, or at once when the
+        board prints start after resetting, for up to timeout seconds.
+        """
+        deadline = time.monotonic() + self.timeout
+        sent = 0
+        while True:
+            self.port.write('M110 N0\n')
+            await self.port.drain()
+            sent += 1
+            wait = min(RESET_WAIT, deadline - time.monotonic())
+            try:
+                line = await self._readline(wait)
+                while not line.startswith(('ok', 'start')):
+                    line = await self._readline(wait)
+            except TimeoutError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError('printer did not answer M110 for %.0f seconds'
+                                       % self.timeout)
+                continue
+            if line.startswith('ok'):
+                break
+        # An M110 that was only slow gets its ok late; don't take that for
+        # the ok of one of the program's lines
+        try:
+            for _ in range(sent - 1):
+                while not (await self._readline(RESET_WAIT)).startswith('ok'):
+                    pass
+        except TimeoutError:
+            pass
+        self.number = 0
+
+    async def send(self, lines, progress=None):
+        """Send program lines (comments are stripped) and wait for every ok
+
+        progress(done, total, program_seconds) is called as lines are
+        acknowledged, program_seconds being the dwell time run so far.
+        Returns SendStats.
+        """
+        program = list(commands(lines))
+        first = self.number + 1
+        last = self.number + len(program)
+        # Dwell seconds up to and including each line, from 0 before the first
+        elapsed = [0.0]
+        for command in program:
+            elapsed.append(elapsed[-1] + dwell_seconds(command))
+        credits = self.window
+        following = first
+        # oks received, and how many of them were for lines Marlin rejected
+        oks = rejected = 0
+        # Resend requests still to come for one already acted on
+        ignore = 0
+        resends = 0
+        started = time.monotonic()
+
+        while True:
+            while credits > 0 and following <= last:
+                self.port.write(frame(following, program[following - first]))
+                following += 1
+                credits -= 1
+            await self.port.drain()
+            done = max(0, min(oks - rejected, len(program)))
+            if following > last and credits == self.window:
+                break
+
+            # Allow for every dwell sent but not yet acknowledged
+            in_flight = elapsed[following - first] - elapsed[done]
+            line = await self._readline(self.timeout + in_flight * self.time_scale)
+            if line.startswith('ok'):
+                credits += 1
+                oks += 1
+                if progress and oks > rejected:
+                    done = min(oks - rejected, len(program))
+                    progress(done, len(program), elapsed[done])
+            elif line.startswith(('Resend:', 'rs ')):
+                if ignore:
+                    # Lines that were in flight behind a bad one each ask
+                    # for the same resend; the first request covers them
+                    ignore -= 1
+                    continue
+                digits = re.sub(r'\D', '', line.split(':', 1)[-1].split(' ', 1)[-1])
+                if not digits:
+                    raise ConnectionError('printer sent a garbled resend request: %r' % line)
+                number = int(digits)
+                if not first <= number < following:
+                    raise ConnectionError('printer asked for line %d, which was not sent' % number)
+                # The bad line and everything sent after it come back as
+                # errors, each with its own ok
+                ignore = following - 1 - number
+                rejected += ignore + 1
+                following = number
+                resends += 1
+
+        self.number = last
+        return SendStats(len(program), resends, time.monotonic() - started, elapsed[-1])
+
+    async def command(self, text):
+        """Send one command and wait for its ok, e.g. M105 to update temps"""
+        return await self.send([text])
+
+    def close(self):
+        self.port.close()
+
+
+async def connect(path, baud=115200, window=WINDOW, timeout=TIMEOUT, time_scale=1.0):
+    """Open the printer on path and return a reset MarlinSender"""
+    port = await SerialPort.open(path, baud)
+    sender = MarlinSender(port, window, timeout, time_scale)
+    try:
+        await sender.reset()
+    except BaseException:
+        sender.close()
+        raise
+    return sender
+
+
+async def send_file(path, port, baud=115200, window=WINDOW, timeout=TIMEOUT,
+                    time_scale=1.0, progress=None):
+    """Stream the program in a file to the printer on port"""
+    sender = await connect(port, baud, window, timeout, time_scale)
+    try:
+        with open(path) as fi:
+            return await sender.send(fi, progress)
+    finally:
+        sender.close()
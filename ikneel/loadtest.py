@@ -0,0 +1,108 @@
+"""
+Load test for the HTTP service in server.py.
+
+    python -m ikneel loadtest http://127.0.0.1:8080/anneal?preset=PLA -c 16 -n 2000
+
+Runs concurrency keep-alive connections, each sending its share of the
+requests one after another, and reports the request rate and latency
+percentiles. With distinct above 1 the soak time is varied over that many
+values, so some of the requests miss the server's cache and are
+generated.
+"""
+
+import asyncio
+import time
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# seconds is the wall time of the whole run; latencies are sorted, seconds
+LoadResult = namedtuple('LoadResult', 'requests errors seconds bytes latencies')
+
+
+def percentile(latencies, fraction):
+    """The latency below which fraction of the (sorted) latencies fall"""
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def targets(url, distinct=1):
+    """The request targets to cycle through, varying soak_time when distinct > 1"""
+    parts = urlsplit(url)
+    if distinct <= 1:
+        return [(parts.path or '/') + ('?' + parts.query if parts.query else '')]
+    params = dict(parse_qsl(parts.query))
+    soak = int(params.get('soak_time', 60))
+    found = []
+    for offset in range(distinct):
+        params['soak_time'] = str(soak + offset)
+        found.append('%s?%s' % (parts.path or '/', urlencode(params)))
+    return found
+
+
+async def read_response(reader):
+    """(status, body length) of one response, reading the body as sent"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('server closed the connection')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        size = 0
+        while True:
+            length = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(length + 2)
+            if not length:
+                return status, size
+            size += length
+    length = int(headers.get('content-length', 0))
+    if status != 304 and length:
+        await reader.readexactly(length)
+    return status, length
+
+
+async def _client(host, port, host_header, paths, count, latencies, totals):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for number in range(count):
+            path = paths[number % len(paths)]
+            started = time.perf_counter()
+            writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, host_header))
+                         .encode('latin-1'))
+            await writer.drain()
+            status, size = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            totals['bytes'] += size
+            if status != 200:
+                totals['errors'] += 1
+    finally:
+        writer.close()
+
+
+async def run(url, concurrency=8, requests=1000, distinct=1):
+    """Send requests GETs to url over concurrency connections, returning LoadResult"""
+    if concurrency < 1 or requests < 1:
+        raise ValueError('concurrency and requests must be 1 or more')
+    parts = urlsplit(url)
+    if parts.scheme != 'http' or not parts.hostname:
+        raise ValueError('need an http:// url, got %r' % url)
+    port = parts.port or 80
+    paths = targets(url, distinct)
+    latencies = []
+    totals = {'bytes': 0, 'errors': 0}
+    shares = [requests // concurrency + (index < requests % concurrency)
+              for index in range(concurrency)]
+    started = time.perf_counter()
+    # Each connection starts at a different target, so misses are spread out
+    await asyncio.gather(*[_client(parts.hostname, port, parts.netloc,
+                                   paths[index:] + paths[:index], share, latencies, totals)
+                           for index, share in enumerate(shares) if share])
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return LoadResult(len(latencies), totals['errors'], seconds, totals['bytes'], latencies)
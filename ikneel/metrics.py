@@ -0,0 +1,177 @@
+"""
+Where the time goes when generating programs, for slow batch runs.
+
+    from ikneel import metrics
+    with metrics.recording() as recorded:
+        run_batch(jobs, 'out')
+    print(recorded.json())
+
+While recording, every program written through writer.write_records is
+split into its phases:
+
+header  the comment header and notes
+heat    the heat ramp
+soak    the soak
+cool    the cool ramp
+footer  turning the bed off
+file    opening and closing output files (writer.open_output), and
+        linking or copying programs from the cache (cache.ProgramCache)
+
+and for each phase the wall time, the part of it spent in writelines, the
+lines and bytes emitted and the writelines calls are added up. While
+recording, write_records also ends a chunk wherever the phase changes, so
+each writelines call holds one phase; that makes a few more, smaller
+writes than usual. The phase time less the write time is formatting; the
+write time and the file time are the file system. Time the max_lines /
+max_bytes search spends trying display intervals counts towards the
+phases too.
+
+programs counts the programs generated, cached those taken from the cache
+instead.
+
+When nothing is recording the generators only check that active is None
+once per phase, so leaving this switched off costs nothing measurable.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+
+PHASES = ('header', 'heat', 'soak', 'cool', 'footer', 'file')
+COUNTERS = ('seconds', 'write_seconds', 'lines', 'bytes', 'writes')
+# For Prometheus: counter name and help text
+EXPORTED = {
+    'seconds': ('phase_seconds_total', 'Wall time spent in each phase of generation'),
+    'write_seconds': ('phase_write_seconds_total', 'Time spent in writelines in each phase'),
+    'lines': ('phase_lines_total', 'Gcode lines emitted in each phase'),
+    'bytes': ('phase_bytes_total', 'Bytes emitted in each phase'),
+    'writes': ('phase_writes_total', 'writelines calls in each phase'),
+}
+
+# The Metrics being recorded into, None when not recording
+active = None
+
+
+class Metrics:
+    """Counters by phase; see the module docstring"""
+
+    def __init__(self):
+        self.phases = {name: dict.fromkeys(COUNTERS, 0) for name in PHASES}
+        self.programs = 0
+        self.cached = 0
+        self.current = None
+        self.since = 0.0
+        # Set while write_records is writing a program, so programs only
+        # measured (writer.measure) are left out
+        self.writing = False
+
+    def enter(self, name):
+        """Start timing phase name, None to stop the clock"""
+        now = time.perf_counter()
+        if self.current is not None:
+            self.phases[self.current]['seconds'] += now - self.since
+        self.current = name
+        self.since = now
+
+    def chunks(self, records, size):
+        """Group records as writer.chunked does, and also where the phase changes
+
+        Yields (phase, chunk), adding each record to the phase it was made in.
+        """
+        self.programs += 1
+        self.writing = True
+        try:
+            chunk = []
+            length = 0
+            phase = None
+            for record in records:
+                current = self.current or 'footer'
+                if current != phase:
+                    if chunk:
+                        yield phase, chunk
+                        chunk = []
+                        length = 0
+                    phase = current
+                counters = self.phases[phase]
+                counters['lines'] += record.count('\n')
+                counters['bytes'] += len(record)
+                chunk.append(record)
+                length += len(record)
+                if length >= size:
+                    yield phase, chunk
+                    chunk = []
+                    length = 0
+            if chunk:
+                yield phase, chunk
+        finally:
+            self.writing = False
+
+    def write(self, fo, chunk, phase):
+        """fo.writelines(chunk), timed against phase"""
+        previous = self.current
+        self.enter(phase)
+        started = time.perf_counter()
+        fo.writelines(chunk)
+        counters = self.phases[phase]
+        counters['write_seconds'] += time.perf_counter() - started
+        counters['writes'] += 1
+        self.enter(previous)
+
+    def report(self):
+        """The counters as a dict, with totals over the phases"""
+        total = {name: sum(self.phases[phase][name] for phase in PHASES)
+                 for name in COUNTERS}
+        return {'programs': self.programs, 'cached': self.cached,
+                'phases': {phase: dict(self.phases[phase]) for phase in PHASES},
+                'total': total}
+
+    def json(self):
+        return json.dumps(self.report(), indent=1)
+
+    def prometheus(self, prefix='ikneel'):
+        """The counters in the Prometheus text exposition format"""
+        lines = ['# HELP %s_programs_total Programs generated' % prefix,
+                 '# TYPE %s_programs_total counter' % prefix,
+                 '%s_programs_total %d' % (prefix, self.programs),
+                 '# HELP %s_cached_programs_total Programs taken from the cache' % prefix,
+                 '# TYPE %s_cached_programs_total counter' % prefix,
+                 '%s_cached_programs_total %d' % (prefix, self.cached)]
+        for counter in COUNTERS:
+            name, text = EXPORTED[counter]
+            lines.append('# HELP %s_%s %s' % (prefix, name, text))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for phase in PHASES:
+                lines.append('%s_%s{phase="%s"} %s' % (prefix, name, phase,
+                                                       repr(self.phases[phase][counter])))
+        return '\n'.join(lines) + '\n'
+
+
+def phase(name):
+    """Mark the start of phase name in the program being written"""
+    if active is not None and active.writing:
+        active.enter(name)
+
+
+def hit():
+    """Count a program taken from the cache instead of generated"""
+    if active is not None:
+        active.cached += 1
+
+
+def clock(name):
+    """Start timing name, None to stop the clock, whatever is being written"""
+    if active is not None:
+        active.enter(name)
+
+
+@contextmanager
+def recording(metrics=None):
+    """Record into metrics, a new Metrics by default, for the with block"""
+    global active
+    previous = active
+    active = Metrics() if metrics is None else metrics
+    try:
+        yield active
+    finally:
+        active.enter(None)
+        active = previous
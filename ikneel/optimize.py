@@ -0,0 +1,103 @@
+"""
+Search heating rate, cooling rate and soak time for the shortest cycle that
+still anneals the part, judged by the thermal model.
+
+Constraints:
+
+max_lag     the part may not trail the bed setpoint by more than this, deg C
+tg          glass transition temperature, deg C, and
+min_above   minutes the part must spend at or above it
+
+ceiling, the highest bed temperature allowed, is only checked against the
+anneal temperature before searching: every candidate peaks at the anneal
+temperature, so it cannot rule out one schedule and not another.
+
+Every heating / cooling rate pair the prompts allow is simulated in one
+batch at the shortest soak. Time above tg grows a minute for every minute
+of soak once the part has caught up, so that gives the soak each pair
+needs; the pairs are simulated again at those soaks to check, and the
+fastest one that passes wins. Needs NumPy.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from . import thermal
+from .gcode import AMBIENT, LIMITS
+
+# A scored schedule. minutes is the whole cycle, max_lag and above as
+# predicted by the thermal model.
+Candidate = namedtuple('Candidate', 'heat_rate soak_time cool_rate minutes max_lag above ok')
+
+# Rounds of raising the soak when the first estimate falls short
+ROUNDS = 4
+
+
+def cycle_minutes(anneal_temp, heat_rate, soak_time, cool_rate, ambient=AMBIENT):
+    """Length of the cycle as written in the file header, minutes"""
+    span = anneal_temp - ambient
+    return span / heat_rate * 60 + soak_time + span / cool_rate * 60
+
+
+def score(anneal_temp, pairs, soaks, tg, ambient=AMBIENT, taus=(), dt=thermal.DT,
+          exact=True, **options):
+    """Simulate (heat_rate, cool_rate) pairs at the given soaks in one batch
+
+    Returns (max_lag, minutes above tg) arrays, one value per pair.
+    """
+    setpoints = [thermal.schedule_setpoints(anneal_temp, heat, soak, cool, ambient, dt,
+                                            exact=exact, **options)
+                 for (heat, cool), soak in zip(pairs, soaks)]
+    traces = thermal.simulate(setpoints, *taus, ambient=ambient, dt=dt)
+    running = np.arange(traces.part.shape[1]) < traces.length[:, None]
+    lag = np.where(running, np.abs(traces.setpoint - traces.part), 0).max(axis=1)
+    above = (running & (traces.part >= tg)).sum(axis=1) * dt / 60
+    return lag, above
+
+
+def optimize(anneal_temp, tg, min_above, max_lag, ceiling=None, ambient=AMBIENT,
+             taus=(), dt=thermal.DT, heat_rates=None, cool_rates=None, exact=True,
+             **options):
+    """Return (best Candidate, every Candidate) for the shortest cycle
+
+    taus are the thermal time constants (bed, air, part); heat_rates and
+    cool_rates default to every whole rate the prompts allow. options are
+    the schedule options of gcode.iter_anneal. Raises ValueError if nothing
+    meets the constraints, or if anneal_temp is above ceiling.
+    """
+    if ceiling is not None and anneal_temp > ceiling:
+        raise ValueError('anneal temperature %d is above the %d deg C ceiling'
+                         % (anneal_temp, ceiling))
+    if tg >= anneal_temp:
+        raise ValueError('tg (%s) must be below the anneal temperature (%d)' % (tg, anneal_temp))
+    heat_rates = heat_rates or range(LIMITS['heat_rate'][0], LIMITS['heat_rate'][1] + 1)
+    cool_rates = cool_rates or range(LIMITS['cool_rate'][0], LIMITS['cool_rate'][1] + 1)
+    pairs = [(heat, cool) for heat in heat_rates for cool in cool_rates]
+    shortest, longest = LIMITS['soak_time']
+
+    soaks = np.full(len(pairs), shortest)
+    for round_ in range(ROUNDS + 1):
+        lag, above = score(anneal_temp, pairs, soaks, tg, ambient, taus, dt, exact, **options)
+        short = (above < min_above) & (soaks < longest)
+        if not short.any() or round_ == ROUNDS:
+            break
+        # Soak longer by what is missing, it all counts once the part is hot
+        more = np.ceil(min_above - above).astype(int)
+        soaks = np.where(short, np.minimum(soaks + more, longest), soaks)
+
+    candidates = []
+    for (heat, cool), soak, lag_, above_ in zip(pairs, soaks, lag, above):
+        ok = bool(lag_ <= max_lag and above_ >= min_above)
+        candidates.append(Candidate(heat, int(soak), cool,
+                                    cycle_minutes(anneal_temp, heat, int(soak), cool, ambient),
+                                    float(lag_), float(above_), ok))
+    passed = [candidate for candidate in candidates if candidate.ok]
+    if not passed:
+        closest = min(candidates, key=lambda candidate: candidate.max_lag)
+        raise ValueError('no schedule meets the constraints; the smallest lag is %.1f deg C'
+                         ' (heat %d, cool %d deg C per hour, %.0f min above tg)'
+                         % (closest.max_lag, closest.heat_rate, closest.cool_rate,
+                            closest.above))
+    best = min(passed, key=lambda candidate: (candidate.minutes, candidate.max_lag))
+    return best, candidates
@@ -0,0 +1,148 @@
+"""
+Material presets, the suggested values from the interactive banner kept in
+a file instead of retyped for every run.
+
+A preset store is a JSON file, or TOML with a .toml name, mapping preset
+names to objects:
+
+    "PETG-thick": {
+        "extends": "PETG",          another preset to start from
+        "aliases": ["petg-thick"],  other names it can be looked up by
+        "soak_time": 240,           any of the generate_anneal parameters
+        "tg": 80,                   glass transition temperature, deg C
+        "note": "..."
+    }
+
+The store is read and checked once, on the first lookup, and every name
+and alias goes into one dict, so resolving a preset for each of
+thousands of jobs is a dict lookup. presets.json next to this file is
+the default store.
+"""
+
+import json
+import os
+
+from .gcode import check_params
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'presets.json')
+
+PARAMS = ('anneal_temp', 'heat_rate', 'soak_time', 'cool_rate', 'ambient')
+# Allowed keys and the types their values may have
+SCHEMA = {
+    'extends': str,
+    'aliases': list,
+    'anneal_temp': int,
+    'heat_rate': int,
+    'soak_time': int,
+    'cool_rate': int,
+    'ambient': int,
+    'tg': (int, float),
+    'note': str,
+}
+REQUIRED = ('anneal_temp', 'heat_rate', 'soak_time', 'cool_rate')
+
+
+class PresetStore:
+    """Presets from one file, looked up by name or alias, any case"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._index = None
+        self._presets = None
+
+    def __getstate__(self):
+        # Workers get the resolved presets instead of parsing the file again
+        self.names()
+        return self.__dict__
+
+    def _load(self):
+        if self.path.lower().endswith('.toml'):
+            import tomllib
+            with open(self.path, 'rb') as fi:
+                raw = tomllib.load(fi)
+        else:
+            with open(self.path) as fi:
+                raw = json.load(fi)
+        if not isinstance(raw, dict):
+            raise ValueError('%s: presets must be an object of name: preset' % self.path)
+        for name, preset in raw.items():
+            check_preset(name, preset, self.path)
+
+        presets = {}
+
+        def resolve(name, chain=()):
+            if name in presets:
+                return presets[name]
+            if name in chain:
+                raise ValueError('%s: presets extend each other in a loop: %s'
+                                 % (self.path, ' -> '.join(chain + (name,))))
+            if name not in raw:
+                raise ValueError('%s: %s extends unknown preset %r' % (self.path, chain[-1], name))
+            own = raw[name]
+            preset = {}
+            if 'extends' in own:
+                preset.update(resolve(own['extends'], chain + (name,)))
+                preset.pop('aliases', None)
+            preset.update((key, value) for key, value in own.items() if key != 'extends')
+            preset['name'] = name
+            presets[name] = preset
+            return preset
+
+        index = {}
+        for name in raw:
+            preset = resolve(name)
+            missing = [key for key in REQUIRED if key not in preset]
+            if missing:
+                raise ValueError('%s: preset %s has no %s' % (self.path, name, ', '.join(missing)))
+            try:
+                check_params(*(preset[key] for key in REQUIRED),
+                             **({'ambient': preset['ambient']} if 'ambient' in preset else {}))
+            except ValueError as err:
+                raise ValueError('%s: preset %s: %s' % (self.path, name, err))
+            for key in [name] + preset.get('aliases', []):
+                other = index.get(key.lower())
+                if other is not None and other is not preset:
+                    raise ValueError('%s: %r names both %s and %s'
+                                     % (self.path, key, other['name'], name))
+                index[key.lower()] = preset
+        self._presets = presets
+        self._index = index
+
+    def get(self, name):
+        """The resolved preset dict for a name or alias, KeyError if none"""
+        if self._index is None:
+            self._load()
+        try:
+            return self._index[name.lower()]
+        except KeyError:
+            raise KeyError('no preset named %r in %s' % (name, self.path))
+
+    def names(self):
+        """Preset names in file order"""
+        if self._index is None:
+            self._load()
+        return list(self._presets)
+
+
+def check_preset(name, preset, path):
+    """Raise ValueError if a preset's keys or value types are wrong"""
+    if not isinstance(preset, dict):
+        raise ValueError('%s: preset %s must be an object' % (path, name))
+    for key, value in preset.items():
+        if key not in SCHEMA:
+            raise ValueError('%s: preset %s has unknown key %r' % (path, name, key))
+        if isinstance(value, bool) or not isinstance(value, SCHEMA[key]):
+            raise ValueError('%s: preset %s: %s has the wrong type' % (path, name, key))
+    if not all(isinstance(alias, str) for alias in preset.get('aliases', [])):
+        raise ValueError('%s: preset %s: aliases must be strings' % (path, name))
+
+
+_stores = {}
+
+
+def store(path=None):
+    """The PresetStore for path, or the default store, shared per process"""
+    path = path or DEFAULT_PATH
+    if path not in _stores:
+        _stores[path] = PresetStore(path)
+    return _stores[path]
@@ -0,0 +1,198 @@
+"""
+Anneal profiles of any number of stages, beyond heat / soak / cool.
+
+A profile is a list of stages, each going on from where the last left
+the bed (the first from ambient):
+
+    {"ramp": 65, "rate": 20}     ramp to 65 deg C at 20 deg C per hour
+    {"hold": 30}                 hold for 30 minutes
+    {"exp": 40, "tau": 120}      cool (or heat) towards ambient as an
+                                 exponential with a tau minute time
+                                 constant, until the bed reaches 40
+
+so PETG with a hold below Tg on the way up and cooling that slows down
+at 65 deg C, as the PETG note suggests, is
+
+    [{"ramp": 70, "rate": 20}, {"hold": 30}, {"ramp": 120, "rate": 20},
+     {"hold": 150}, {"ramp": 65, "rate": 10}, {"ramp": 27, "rate": 5}]
+
+compile_stages() turns the stages into schedule Segments, the one form
+the emitters, the thermal model and the time estimate work from: a ramp
+up is a heat segment, a hold a soak segment, a ramp down a cool segment,
+and an exponential a run of short ramps, one per step deg C. Adjacent
+ramps of the same rate are merged. The program is always cut with the
+exact schedule, as the stages need not start on whole degrees.
+
+A profile file is JSON, or TOML with a .toml name:
+
+    {"material": "PETG", "ambient": 27, "stages": [...]}
+"""
+
+import json
+import math
+
+from . import metrics
+from .gcode import AMBIENT, CHAMBER_OFF, COMPACT_NOTE, FOOTER, LIMITS, chamber_note, emit_plan
+from .schedule import CHAMBER_MAX, Segment, format_temp, hold, link_chamber, plan, ramp
+from .writer import BUFFER_SIZE, open_output, write_records
+
+PROFILE_HEADER = (
+    '; gcode to control heat bed to anneal printed parts\n'
+    '; Material is: %s\n'
+    '; Profile of %d stages from %s deg C, taking %.1f minutes (%.2f hours)\n'
+)
+STAGE_NOTE = '; Stage %d: %s\n'
+PROFILE_START = (
+    '; \n'
+    'M84 ; Make sure motors are OFF\n'
+    'M104 S0 ; Make sure extruder is OFF\n'
+    '; \n'
+)
+KINDS = ('ramp', 'hold', 'exp')
+# Keys each kind of stage takes besides its own
+EXTRA = {'ramp': ('rate',), 'hold': (), 'exp': ('tau',)}
+
+
+def check_stage(number, stage, temp, ambient):
+    """Raise ValueError unless a stage makes sense starting at temp"""
+    if not isinstance(stage, dict):
+        raise ValueError('stage %d must be an object' % number)
+    kinds = [kind for kind in KINDS if kind in stage]
+    if len(kinds) != 1:
+        raise ValueError('stage %d needs one of %s' % (number, ', '.join(KINDS)))
+    kind = kinds[0]
+    unknown = set(stage) - {kind} - set(EXTRA[kind])
+    missing = [key for key in EXTRA[kind] if key not in stage]
+    if unknown or missing:
+        raise ValueError('stage %d (%s) takes %s' % (
+            number, kind, ', '.join((kind,) + EXTRA[kind])))
+    for key, value in stage.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError('stage %d: %s must be a number above 0, got %r'
+                             % (number, key, value))
+    if kind == 'hold':
+        return
+    target = stage[kind]
+    if target > LIMITS['anneal_temp'][1]:
+        raise ValueError('stage %d: %g deg C is above %d' % (number, target,
+                                                             LIMITS['anneal_temp'][1]))
+    if target == temp:
+        raise ValueError('stage %d: the bed is already at %g deg C' % (number, target))
+    if kind == 'exp' and not min(temp, ambient) < target < max(temp, ambient):
+        raise ValueError('stage %d: an exponential from %g deg C towards ambient %g'
+                         ' never reaches %g' % (number, temp, ambient, target))
+
+
+def exp_segments(start, end, tau, ambient, step=1):
+    """Short ramps following T = ambient + (start - ambient) e^(-t / tau) to end"""
+    phase = 'heat' if end > start else 'cool'
+    count = max(1, math.ceil(abs(end - start) / step - 1e-9))
+    segments = []
+    temp = start
+    for k in range(1, count + 1):
+        following = start + (end - start) * k / count
+        minutes = tau * math.log((temp - ambient) / (following - ambient))
+        segments.append(Segment(phase, temp, following, abs(following - temp) * 60 / minutes,
+                                minutes))
+        temp = following
+    return segments
+
+
+def compile_stages(stages, ambient=AMBIENT, step=1):
+    """The list of Segments for a list of stages, see the module docstring"""
+    if not stages:
+        raise ValueError('a profile needs at least one stage')
+    segments = []
+    temp = ambient
+    for number, stage in enumerate(stages, 1):
+        check_stage(number, stage, temp, ambient)
+        if 'hold' in stage:
+            new = [hold('soak', temp, stage['hold'])]
+        elif 'ramp' in stage:
+            new = [ramp('heat' if stage['ramp'] > temp else 'cool', temp, stage['ramp'],
+                        stage['rate'])]
+            temp = stage['ramp']
+        else:
+            new = exp_segments(temp, stage['exp'], stage['tau'], ambient, step)
+            temp = stage['exp']
+        for segment in new:
+            last = segments[-1] if segments else None
+            if last and last.rate and last.rate == segment.rate and last.phase == segment.phase:
+                segments[-1] = ramp(last.phase, last.start, segment.end, last.rate)
+            else:
+                segments.append(segment)
+    return segments
+
+
+def describe(stage):
+    """A stage in words, for the header"""
+    if 'hold' in stage:
+        return 'hold for %g minutes' % stage['hold']
+    if 'ramp' in stage:
+        return 'ramp to %g deg C at %g deg C per hour' % (stage['ramp'], stage['rate'])
+    return 'exponential to %g deg C, time constant %g minutes' % (stage['exp'], stage['tau'])
+
+
+def load_profile(path):
+    """Read a profile file, returning (material, ambient, stages)"""
+    if path.lower().endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as fi:
+            raw = tomllib.load(fi)
+    else:
+        with open(path) as fi:
+            raw = json.load(fi)
+    if not isinstance(raw, dict) or not isinstance(raw.get('stages'), list):
+        raise ValueError('%s: a profile is an object with a list of stages' % path)
+    unknown = set(raw) - {'material', 'ambient', 'stages'}
+    if unknown:
+        raise ValueError('%s: unknown profile key(s): %s' % (path, ', '.join(sorted(unknown))))
+    return raw.get('material', 'profile'), raw.get('ambient', AMBIENT), raw['stages']
+
+
+def iter_profile(material, stages, ambient=AMBIENT, compact=0, step=1, chamber_offset=None,
+                 chamber_lag=0, chamber_max=CHAMBER_MAX):
+    """Yield the program for a profile, like gcode.iter_anneal
+
+    compact is the display update interval in minutes, 0 for every step,
+    and step the deg C per ramp step. The chamber options are as for
+    iter_anneal. Bad stages raise ValueError here, before anything is
+    yielded.
+    """
+    if compact < 0:
+        raise ValueError('compact must be 0 or more minutes, got %r' % compact)
+    segments = compile_stages(stages, ambient, step)
+    planned = plan(segments, exact=True, step=step)
+    note = None
+    if chamber_offset is not None:
+        planned = link_chamber(planned, chamber_offset, chamber_lag, chamber_max)
+        note = chamber_note(planned, chamber_offset, chamber_lag, chamber_max)
+    elif chamber_lag or chamber_max != CHAMBER_MAX:
+        raise ValueError('chamber_lag and chamber_max need a chamber_offset')
+    return _iter_profile(material, stages, ambient, compact, segments, planned, note)
+
+
+def _iter_profile(material, stages, ambient, compact, segments, planned, note):
+    minutes = sum(segment.minutes for segment in segments)
+    metrics.phase('header')
+    yield PROFILE_HEADER % (material, len(stages), format_temp(ambient), minutes, minutes / 60)
+    for number, stage in enumerate(stages, 1):
+        yield STAGE_NOTE % (number, describe(stage))
+    yield PROFILE_START
+    if note:
+        yield note
+    if compact:
+        yield COMPACT_NOTE % compact
+    yield from emit_plan(planned, compact, note is not None)
+    metrics.phase('footer')
+    if note:
+        yield CHAMBER_OFF
+    yield FOOTER
+
+
+def write_profile(path, material, stages, ambient=AMBIENT, compress=False,
+                  buffer_size=BUFFER_SIZE, **options):
+    """Write a profile's program to path, '-' for stdout, returning writer.Written"""
+    records = iter_profile(material, stages, ambient, **options)
+    with open_output(path, compress) as fo:
+        return write_records(records, fo, buffer_size)
@@ -0,0 +1,225 @@
+"""
+Pick a cycle up part way through, after a power cut or a reset.
+
+ScheduleIndex is built once from the planned steps of a cycle: the start
+time of every step, and the ramp setpoints in order. Finding where to
+pick up is then a bisect, by time since the cycle started or by the bed
+temperature during a ramp, and iter_resume() writes the rest of the
+program from there with the same templates as a whole one.
+
+For programs already on disk, write_offsets() records a sidecar
+(FILE.gcode.idx.json) of schedule times and the byte offsets of the
+steps starting at them, so a host can seek straight into the file with
+seek_offset().
+"""
+
+import json
+import mmap
+import os
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from functools import lru_cache
+from itertools import groupby
+
+from . import metrics
+from .analyze import COMMAND
+from .gcode import AMBIENT, COMPACT_NOTE, EXACT_NOTE, FOOTER, HEADER, PHASES, check_params, \
+    emit_steps
+from .schedule import anneal_segments, format_temp, plan
+from .writer import open_output, write_records
+
+RESUME_NOTE = '; Resumed %d minutes into the cycle, %s, setpoint %s deg C\n'
+SOAK_RESUME = 'M140 S%s ; Back to the soak temperature\n'
+
+# Where to pick up: the step index in ScheduleIndex.steps and the seconds
+# of that step already done
+Position = namedtuple('Position', 'index into')
+
+
+class ScheduleIndex:
+    """Step start times and ramp setpoints of a planned cycle, for bisecting"""
+
+    def __init__(self, planned):
+        self.steps = []
+        self.starts = []
+        now = 0
+        for segment, steps in planned:
+            for step in steps:
+                self.starts.append(now)
+                self.steps.append(step)
+                now += step.dwell
+        self.total = now
+        # Ramp setpoints made increasing (cooling ones negated) with the
+        # index of their step
+        self.ramps = {}
+        for phase, sign in (('heat', 1), ('cool', -1)):
+            indexes = [index for index, step in enumerate(self.steps) if step.phase == phase]
+            self.ramps[phase] = ([sign * self.steps[index].setpoint for index in indexes],
+                                 indexes)
+
+    def at_time(self, seconds):
+        """The Position seconds after the cycle started"""
+        if not 0 <= seconds < self.total:
+            raise ValueError('the cycle runs %.0f minutes, cannot resume at %.0f'
+                             % (self.total / 60.0, seconds / 60.0))
+        index = bisect_right(self.starts, seconds) - 1
+        return Position(index, seconds - self.starts[index])
+
+    def at_temp(self, temp, phase):
+        """The Position to carry on a heat or cool ramp with the bed at temp
+
+        That is the first step setting the bed past temp, so the ramp goes
+        on from where the bed is. Heating past the top goes to the soak.
+        """
+        if phase not in self.ramps:
+            raise ValueError('resume by temperature is for heat or cool, not %r; give the'
+                             ' elapsed time for the soak' % phase)
+        sign = 1 if phase == 'heat' else -1
+        keys, indexes = self.ramps[phase]
+        position = bisect_right(keys, sign * temp)
+        if position < len(indexes):
+            return Position(indexes[position], 0)
+        if phase == 'heat':
+            return Position(indexes[-1] + 1, 0) if indexes else Position(0, 0)
+        raise ValueError('the bed at %g C has already cooled past the last setpoint' % temp)
+
+    def time_of(self, position):
+        return self.starts[position.index] + position.into
+
+
+@lru_cache(maxsize=64)
+def schedule_index(anneal_temp, heat_rate, soak_time, cool_rate, ambient=AMBIENT,
+                   exact=False, step=1, commands=None):
+    """The ScheduleIndex of a cycle, kept for the next lookup on the same one"""
+    segments = anneal_segments(anneal_temp, heat_rate, soak_time, cool_rate, ambient)
+    return ScheduleIndex(plan(segments, exact, step, commands))
+
+
+def iter_resume(material, anneal_temp, heat_rate, soak_time, cool_rate, ambient=AMBIENT,
+                elapsed=None, temp=None, phase=None, compact=0, exact=False, step=1,
+                commands=None):
+    """Yield the program from elapsed seconds into the cycle, or from temp in phase
+
+    The header is that of the whole program, with a note of where it was
+    resumed. The other options are as for iter_anneal. Bad parameters or
+    a point outside the cycle raise ValueError here, before anything is
+    yielded.
+    """
+    check_params(anneal_temp, heat_rate, soak_time, cool_rate, ambient)
+    if (elapsed is None) == (temp is None):
+        raise ValueError('resume needs either the elapsed time or the bed temperature')
+    segments = anneal_segments(anneal_temp, heat_rate, soak_time, cool_rate, ambient)
+    index = schedule_index(anneal_temp, heat_rate, soak_time, cool_rate, ambient,
+                           exact, step, commands)
+    position = index.at_time(elapsed) if temp is None else index.at_temp(temp, phase)
+    steps = index.steps[position.index:]
+    if not steps:
+        raise ValueError('nothing left of the cycle to resume')
+    first = steps[0]
+    # Whole seconds of the first dwell that are left to do
+    steps[0] = first._replace(dwell=first.dwell - int(position.into))
+    return _iter_resume(material, anneal_temp, heat_rate, soak_time, cool_rate, segments,
+                        index, position, steps, compact, exact)
+
+
+def _iter_resume(material, anneal_temp, heat_rate, soak_time, cool_rate, segments, index,
+                 position, steps, compact, exact):
+    first = steps[0]
+    setpoint = anneal_temp if first.setpoint is None else first.setpoint
+    heat, cool = segments[0], segments[2]
+
+    metrics.phase('header')
+    yield HEADER % (material, anneal_temp, heat.minutes, heat.minutes/60, heat_rate,
+                    soak_time, cool_rate, cool.minutes, cool.minutes/60)
+    yield RESUME_NOTE % (index.time_of(position) // 60, first.phase, format_temp(setpoint))
+    if exact:
+        yield EXACT_NOTE % (len(index.ramps['heat'][1]), len(index.ramps['cool'][1]))
+    if compact:
+        yield COMPACT_NOTE % compact
+    update = compact * 60
+    if first.phase == 'soak':
+        yield SOAK_RESUME % format_temp(setpoint)
+    for phase, run in groupby(steps, key=lambda item: item.phase):
+        metrics.phase(phase)
+        start, template, compact_template = PHASES[phase]
+        if start:
+            yield start
+        yield from emit_steps(list(run), compact_template if compact else template, update)
+    metrics.phase('footer')
+    yield FOOTER
+
+
+def write_resume(path, material, anneal_temp, heat_rate, soak_time, cool_rate,
+                 ambient=AMBIENT, compress=False, **options):
+    """Write the resumed program to path, '-' for stdout; see iter_resume"""
+    records = iter_resume(material, anneal_temp, heat_rate, soak_time, cool_rate, ambient,
+                          **options)
+    with open_output(path, compress) as fo:
+        return write_records(records, fo)
+
+
+def sidecar_path(path):
+    return path + '.idx.json'
+
+
+def scan_offsets(data):
+    """(seconds, byte offset, setpoint) where each step of a program starts
+
+    A step starts at an M140, or at a G4 on its own during the soak.
+    """
+    entries = []
+    now = 0.0
+    setpoint = 0.0
+    after_setpoint = False
+    for match in COMMAND.finditer(data):
+        value, unit, dwell = match.groups()
+        if value:
+            setpoint = float(value)
+            entries.append((now, match.start(), setpoint))
+            after_setpoint = True
+            continue
+        if not after_setpoint:
+            entries.append((now, match.start(), setpoint))
+        after_setpoint = False
+        now += float(dwell) if unit == b'S' else float(dwell) / 1000
+    return entries
+
+
+def write_offsets(path):
+    """Write the sidecar index of an existing .gcode file, returning its path"""
+    with open(path, 'rb') as fi:
+        size = os.fstat(fi.fileno()).st_size
+        if not size:
+            entries = []
+        else:
+            with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                entries = scan_offsets(data)
+    sidecar = sidecar_path(path)
+    with open(sidecar, 'w') as fo:
+        json.dump({'size': size,
+                   'seconds': [entry[0] for entry in entries],
+                   'offsets': [entry[1] for entry in entries],
+                   'setpoints': [entry[2] for entry in entries]}, fo)
+    return sidecar
+
+
+def read_offsets(path):
+    """The sidecar index of path, ValueError if it is missing or out of date"""
+    try:
+        with open(sidecar_path(path)) as fi:
+            index = json.load(fi)
+    except (OSError, ValueError):
+        raise ValueError('%s has no readable index, make one with write_offsets()' % path)
+    if index['size'] != os.path.getsize(path):
+        raise ValueError('%s has changed since its index was written' % path)
+    return index
+
+
+def seek_offset(index, seconds):
+    """Byte offset of the step running seconds into the program, and its start time"""
+    position = bisect_right(index['seconds'], seconds) - 1
+    if position < 0:
+        return 0, 0.0
+    # Several entries can share a time (a zero dwell); take the first
+    position = bisect_left(index['seconds'], index['seconds'][position])
+    return index['offsets'][position], index['seconds'][position]
@@ -0,0 +1,183 @@
+"""
+Schedule engine: the anneal cycle as segments, and segments as dwell steps.
+
+A Segment is one straight line of bed setpoint against time, a ramp at a
+rate or a hold for a number of minutes. Steps are what the gcode writer
+turns into M140 / G4 / M117 lines.
+
+Two ways of cutting a ramp into steps:
+
+legacy  what version 2.02 wrote. One degree per step starting AT ambient,
+        the dwell truncated with int() and the cooling countdown dropping by
+        int(DwellCool / 60) a step. Kept so existing programs can be
+        regenerated byte for byte.
+
+exact   steps of any size, fractional or several degrees, or a given number
+        of steps. Each step ends on the whole second nearest the exact
+        schedule time, so the rounding error is carried forward instead of
+        piling up and the ramp takes as long as the rate says. The
+        countdown is the exact time left, rounded to the minute.
+
+link_chamber() adds a second channel, an enclosure heater (M141) whose
+setpoint follows the bed's by an offset and a lag.
+"""
+
+import math
+from bisect import bisect_right
+from collections import namedtuple
+
+# Highest chamber setpoint written unless told otherwise, deg C
+CHAMBER_MAX = 60
+
+# phase is 'heat', 'soak' or 'cool'. start / end are bed setpoints in deg C,
+# rate is deg C per hour (None for a hold) and minutes the segment length.
+Segment = namedtuple('Segment', 'phase start end rate minutes')
+
+# One dwell. setpoint is the M140 value, None to keep the current one,
+# dwell the whole seconds of G4 and remaining the minutes of the phase left
+# after it, as shown on the display. chamber is the M141 value to set
+# before it, None for no change (and always None without a chamber).
+Step = namedtuple('Step', 'phase setpoint dwell remaining chamber', defaults=(None,))
+
+
+def ramp(phase, start, end, rate):
+    """A Segment going from start to end at rate deg C per hour"""
+    return Segment(phase, start, end, rate, abs(end - start) / rate * 60)
+
+
+def hold(phase, temp, minutes):
+    """A Segment holding temp for minutes"""
+    return Segment(phase, temp, temp, None, minutes)
+
+
+def anneal_segments(anneal_temp, heat_rate, soak_time, cool_rate, ambient):
+    """The heat / soak / cool cycle"""
+    return [ramp('heat', ambient, anneal_temp, heat_rate),
+            hold('soak', anneal_temp, soak_time),
+            ramp('cool', anneal_temp, ambient, cool_rate)]
+
+
+def format_temp(temp):
+    """Setpoint as written after M140 S, whole degrees without a decimal point"""
+    temp = round(temp, 1)
+    if temp == int(temp):
+        return '%d' % temp
+    return '%.1f' % temp
+
+
+def legacy_steps(segment):
+    """Steps exactly as version 2.02 cut them"""
+    if segment.rate is None:
+        return [Step(segment.phase, None, 60, num)
+                for num in range(int(segment.minutes) - 1, -1, -1)]
+    # How long in seconds between changes in target temperature
+    dwell = 3600 / segment.rate
+    left = segment.minutes
+    steps = []
+    if segment.end > segment.start:
+        for num in range(segment.start, segment.end + 1):
+            left = left - (dwell / 60)
+            steps.append(Step(segment.phase, num, int(dwell), int(left)))
+    else:
+        for num in range(segment.start, segment.end, -1):
+            left = left - int(dwell / 60)
+            steps.append(Step(segment.phase, num, int(dwell), int(left)))
+    return steps
+
+
+def exact_steps(segment, step=1, count=None):
+    """Steps of about step deg C, or count of them, with no drift
+
+    A hold is cut into whole minutes (the last one may be short).
+    """
+    seconds = segment.minutes * 60
+    if segment.rate is None:
+        count = max(1, math.ceil(segment.minutes))
+        times = [min(60 * k, seconds) for k in range(1, count + 1)]
+        setpoints = [None] * count
+    else:
+        span = segment.end - segment.start
+        if not count:
+            if step <= 0:
+                raise ValueError('step must be above 0 deg C, got %r' % step)
+            # The small allowance stops 93 / 0.1 becoming 931 steps
+            count = max(1, math.ceil(abs(span) / step - 1e-9))
+        times = [seconds * k / count for k in range(1, count + 1)]
+        setpoints = [segment.start + span * k / count for k in range(1, count + 1)]
+    steps = []
+    done = 0
+    for time, setpoint in zip(times, setpoints):
+        # End each dwell on the second nearest the exact time, so the error
+        # from rounding one dwell is taken back by the next
+        end = round(time)
+        steps.append(Step(segment.phase, setpoint, end - done,
+                          int(round((seconds - time) / 60))))
+        done = end
+    return steps
+
+
+def plan(segments, exact=False, step=1, commands=None):
+    """Cut segments into steps, returning a list of (segment, steps)
+
+    commands, in exact mode, is how many setpoint changes the ramps should
+    take in total. They are shared out by the degrees each ramp covers.
+    """
+    if not exact:
+        return [(segment, legacy_steps(segment)) for segment in segments]
+    counts = {}
+    if commands:
+        ramps = [index for index, segment in enumerate(segments) if segment.rate]
+        total = sum(abs(segments[index].end - segments[index].start) for index in ramps)
+        for index in ramps:
+            span = abs(segments[index].end - segments[index].start)
+            counts[index] = max(1, int(round(commands * span / total)))
+    return [(segment, exact_steps(segment, step, counts.get(index)))
+            for index, segment in enumerate(segments)]
+
+
+def check_chamber(offset, lag, maximum):
+    """Raise ValueError unless the link_chamber options are usable numbers"""
+    for name, value in (('offset', offset), ('lag', lag), ('maximum', maximum)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or not math.isfinite(value):
+            raise ValueError('the chamber %s must be a finite number, got %r' % (name, value))
+    if maximum <= 0:
+        raise ValueError('the chamber maximum must be above 0 deg C, got %r' % maximum)
+
+
+def link_chamber(planned, offset=0, lag=0, maximum=CHAMBER_MAX):
+    """planned with chamber setpoints: the bed's lag minutes earlier, plus offset
+
+    A negative lag leads the bed instead. Before the cycle the bed is at
+    the first segment's start, after it at the last setpoint. The chamber
+    is set at the start of a step, when its setpoint (as written) changes,
+    and is kept between 0 and maximum deg C.
+    """
+    check_chamber(offset, lag, maximum)
+    # Start time of every step and the bed setpoint from then on
+    starts = []
+    beds = []
+    now = 0
+    bed = first = planned[0][0].start
+    for segment, steps in planned:
+        for step in steps:
+            if step.setpoint is not None:
+                bed = step.setpoint
+            starts.append(now)
+            beds.append(bed)
+            now += step.dwell
+    written = None
+    linked = []
+    index = 0
+    for segment, steps in planned:
+        chambered = []
+        for step in steps:
+            at = bisect_right(starts, starts[index] - lag * 60) - 1
+            temp = min(maximum, max(0, (beds[at] if at >= 0 else first) + offset))
+            if format_temp(temp) != written:
+                written = format_temp(temp)
+                step = step._replace(chamber=temp)
+            chambered.append(step)
+            index += 1
+        linked.append((segment, chambered))
+    return linked
@@ -0,0 +1,268 @@
+"""
+Small HTTP service, so a tablet on the workshop network can fetch a program.
+
+    python -m ikneel serve --port 8080
+
+    GET /anneal?material=PLA&anneal_temp=80&heat_rate=20&soak_time=60&cool_rate=10
+    GET /anneal?preset=PETG&soak_time=90&compact=10
+    GET /presets
+    GET /stats
+
+/anneal takes the job fields of a job file (material, anneal_temp, ...,
+or preset) checked against the same limits as the prompts, and the output
+options compact, exact, step (at least MIN_STEP), commands (at most
+MAX_COMMANDS), firmware, chamber_offset, chamber_lag and chamber_max.
+The program streams back with chunked transfer encoding as it is
+generated. The same query always gives the same program, so responses
+carry an ETag (the cache key) and may be cached for a day; If-None-Match
+gets a 304.
+
+Recent programs are kept in memory, least recently used going first, and
+served whole from there. One asyncio event loop serves every connection:
+each chunk is handed to the socket and the loop given back to the other
+connections before the next is generated, so a long program does not
+hold up the other requests.
+"""
+
+import asyncio
+import json
+import math
+import re
+from collections import OrderedDict
+from itertools import chain
+from urllib.parse import parse_qsl, urlsplit
+
+from .batch import FIELDS, job_args, make_job
+from .cache import program_key
+from .gcode import file_name, iter_anneal
+from .presets import store as preset_store
+from .writer import chunked
+
+# Characters per HTTP chunk; small so the first bytes go out at once
+CHUNK = 16 * 1024
+MAX_HEADERS = 100
+# Limits on the options that set how many steps a program has, so one
+# request cannot take the service over: the finest step in deg C and the
+# most setpoint changes
+MIN_STEP = 0.1
+MAX_COMMANDS = 5000
+CACHE_CONTROL = 'public, max-age=86400'
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed'}
+TRUE = ('1', 'true', 'yes', 'on')
+MATERIAL = re.compile(r'^[\w .+-]{1,64}$', re.ASCII)
+
+
+class LRU:
+    """Program bodies by key, dropping the least recently used past the limits"""
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+
+    def put(self, key, body):
+        if key in self.entries or len(body) > self.max_bytes:
+            return
+        self.entries[key] = body
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+
+def parse_options(params):
+    """Pop the output options out of query params, as iter_anneal keywords"""
+    options = {}
+    try:
+        if 'compact' in params:
+            options['compact'] = int(params.pop('compact'))
+        if 'exact' in params:
+            options['exact'] = params.pop('exact').lower() in TRUE
+        if 'step' in params:
+            options['step'] = float(params.pop('step'))
+        if 'commands' in params:
+            options['commands'] = int(params.pop('commands'))
+        for name in ('chamber_offset', 'chamber_lag', 'chamber_max'):
+            if name in params:
+                options[name] = float(params.pop(name))
+    except ValueError as err:
+        raise ValueError('bad option: %s' % err)
+    for name, value in options.items():
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError('%s must be a finite number, got %r' % (name, value))
+    if 'step' in options and not options['step'] >= MIN_STEP:
+        raise ValueError('step must be at least %g deg C, got %r' % (MIN_STEP, options['step']))
+    if 'commands' in options and not 0 <= options['commands'] <= MAX_COMMANDS:
+        raise ValueError('commands must be 0 to %d, got %d'
+                         % (MAX_COMMANDS, options['commands']))
+    # Only named when not Marlin, so Marlin programs keep the keys of cache.py
+    firmware = params.pop('firmware', 'marlin')
+    if firmware != 'marlin':
+        options['firmware'] = firmware
+    return options
+
+
+class AnnealServer:
+    """The HTTP service; serve() runs it until cancelled"""
+
+    def __init__(self, presets=None, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.presets = presets
+        self.lru = LRU(max_entries, max_bytes)
+        self.stats = {'requests': 0, 'hits': 0, 'misses': 0, 'not_modified': 0, 'errors': 0}
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """One connection, any number of requests while it is kept alive"""
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, version, headers = request
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep = connection != 'close'
+                else:
+                    keep = connection == 'keep-alive'
+                self.stats['requests'] += 1
+                await self.respond(writer, method, target, version, headers, keep)
+                if not keep:
+                    break
+        except ValueError as err:
+            self.stats['errors'] += 1
+            send(writer, 400, {'Connection': 'close'}, ('%s\n' % err).encode())
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            try:
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def respond(self, writer, method, target, version, headers, keep):
+        connection = {'Connection': 'keep-alive' if keep else 'close'}
+        url = urlsplit(target)
+        if method not in ('GET', 'HEAD'):
+            send(writer, 405, dict(connection, Allow='GET, HEAD'), b'GET or HEAD only\n')
+        elif url.path == '/anneal':
+            try:
+                await self.anneal(writer, method, dict(parse_qsl(url.query)), headers,
+                                  connection, version == 'HTTP/1.1')
+            except ValueError as err:
+                self.stats['errors'] += 1
+                send(writer, 400, connection, ('%s\n' % err).encode(), method)
+        elif url.path == '/presets':
+            presets = self.presets or preset_store()
+            body = json.dumps([presets.get(name) for name in presets.names()], indent=1)
+            send(writer, 200, dict(connection, **{'Content-Type': 'application/json',
+                                                  'Cache-Control': 'no-cache'}),
+                 (body + '\n').encode(), method)
+        elif url.path == '/stats':
+            body = json.dumps(dict(self.stats, cached=len(self.lru.entries),
+                                   cached_bytes=self.lru.size))
+            send(writer, 200, dict(connection, **{'Content-Type': 'application/json',
+                                                  'Cache-Control': 'no-store'}),
+                 (body + '\n').encode(), method)
+        else:
+            send(writer, 404, connection, b'try /anneal, /presets or /stats\n', method)
+        await writer.drain()
+
+    async def anneal(self, writer, method, params, headers, connection, stream=True):
+        options = parse_options(params)
+        row = {name: params.pop(name) for name in FIELDS + ('preset',) if name in params}
+        if params:
+            raise ValueError('unknown parameter(s): ' + ', '.join(sorted(params)))
+        job = make_job(row, self.presets)
+        if not MATERIAL.match(job['material']):
+            # It goes into the gcode header comment and the file name
+            raise ValueError('material may only have letters, digits, spaces and . _ + -')
+        key = program_key(job_args(job), options)
+        response = {
+            'Content-Type': 'text/plain; charset=us-ascii',
+            'Content-Disposition': 'attachment; filename="%s.gcode"'
+                                   % file_name(*job_args(job)[:5]),
+            'ETag': '"%s"' % key,
+            'Cache-Control': CACHE_CONTROL,
+        }
+        response.update(connection)
+        if headers.get('if-none-match') in (response['ETag'], '*'):
+            self.stats['not_modified'] += 1
+            send(writer, 304, response)
+            return
+        body = self.lru.get(key)
+        if body is not None:
+            self.stats['hits'] += 1
+            send(writer, 200, response, body, method)
+            return
+        self.stats['misses'] += 1
+        records = iter_anneal(*job_args(job), **options)
+        # The first record checks the options, so errors are still a 400
+        first = next(records)
+        if method == 'HEAD' or not stream:
+            # HTTP/1.0 has no chunked encoding
+            body = ''.join(chain([first], records)).encode('ascii')
+            self.lru.put(key, body)
+            send(writer, 200, response, body, method)
+            return
+        response['Transfer-Encoding'] = 'chunked'
+        send(writer, 200, response)
+        parts = []
+        for chunk in chunked(chain([first], records), CHUNK):
+            data = ''.join(chunk).encode('ascii')
+            parts.append(data)
+            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+            await writer.drain()
+            # drain() only waits when the socket is backed up; let the
+            # other connections run between chunks either way
+            await asyncio.sleep(0)
+        writer.write(b'0\r\n\r\n')
+        self.lru.put(key, b''.join(parts))
+
+
+async def read_request(reader):
+    """(method, target, version, headers) of the next request, None at EOF"""
+    line = await reader.readline()
+    # Blank lines between requests are allowed
+    while line in (b'\r\n', b'\n'):
+        line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise ValueError('bad request line')
+    headers = {}
+    for _ in range(MAX_HEADERS):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return method, target, version, headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    raise ValueError('too many headers')
+
+
+def send(writer, status, headers, body=None, method='GET'):
+    """Write a response head, and body unless it is None or method is HEAD"""
+    lines = ['HTTP/1.1 %d %s' % (status, REASONS[status])]
+    if body is not None:
+        headers = dict(headers, **{'Content-Length': str(len(body))})
+        headers.setdefault('Content-Type', 'text/plain; charset=us-ascii')
+    lines.extend('%s: %s' % item for item in headers.items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    if body and method != 'HEAD':
+        writer.write(body)
@@ -0,0 +1,157 @@
+"""
+Lumped capacitance model of the part under the box, to see how closely it
+follows the M140 setpoints without a 10 hour run.
+
+    setpoint -> bed -> air under the box -> part
+
+Each arrow is a first order lag with its own time constant in seconds. The
+defaults are guesses for a cardboard box on a 220 mm bed and are untested;
+measure your own and pass them in.
+
+Everything is done with NumPy arrays. A trace is sampled every dt seconds
+and the three lags are applied together in the frequency domain, so a
+batch of thousands of schedules and/or time constants is a few FFTs
+rather than a Python loop per time step. NumPy is only needed for this
+module and the ones built on it.
+"""
+
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError('the thermal model needs NumPy:  pip install numpy')
+
+from .gcode import AMBIENT
+from .schedule import anneal_segments, plan
+
+# Time constants, seconds
+TAU_BED = 300
+TAU_AIR = 600
+TAU_PART = 900
+
+# Seconds between samples
+DT = 30
+
+# Rows simulated per FFT, to keep memory down on big batches
+CHUNK = 512
+
+# Traces are (rows, samples) arrays, deg C, sample n at time n * dt.
+# length is how many samples of each row belong to its program, the rest
+# is padding after the heater has been turned off.
+Traces = namedtuple('Traces', 'dt length setpoint bed air part')
+
+
+def schedule_setpoints(anneal_temp, heat_rate, soak_time, cool_rate,
+                       ambient=AMBIENT, dt=DT, exact=True, **options):
+    """Sample the bed setpoint of one anneal program every dt seconds
+
+    options are the schedule options of gcode.iter_anneal (step, commands).
+    The trace ends when the heater is turned off.
+    """
+    segments = anneal_segments(anneal_temp, heat_rate, soak_time, cool_rate, ambient)
+    return steps_setpoints(plan(segments, exact, **options), ambient, dt)
+
+
+def steps_setpoints(planned, ambient=AMBIENT, dt=DT):
+    """Sample the setpoint of planned (segment, steps) pairs every dt seconds"""
+    ends = []
+    values = []
+    time = 0
+    current = ambient
+    for segment, steps in planned:
+        for step in steps:
+            if step.setpoint is not None:
+                current = step.setpoint
+            time += step.dwell
+            ends.append(time)
+            values.append(current)
+    ends = np.asarray(ends, dtype=float)
+    values = np.asarray(values, dtype=float)
+    samples = np.arange(0, time, dt, dtype=float)
+    # A step holds its setpoint up to, not including, its end time
+    return values[np.searchsorted(ends, samples, side='right')]
+
+
+def stack(traces, ambient=AMBIENT):
+    """Pad setpoint traces of different lengths with ambient into one array
+
+    ambient may be one value or one per trace. Returns (array, lengths).
+    """
+    lengths = np.array([len(trace) for trace in traces])
+    ambient = np.broadcast_to(np.asarray(ambient, dtype=float), (len(traces),))
+    out = np.repeat(ambient[:, None], lengths.max(), axis=1)
+    for row, trace in enumerate(traces):
+        out[row, :len(trace)] = trace
+    return out, lengths
+
+
+def lag_response(tau, dt, frequencies):
+    """Frequency response of a first order lag sampled every dt seconds
+
+    T[n+1] = a T[n] + (1 - a) u[n] with a = exp(-dt / tau), which is exact
+    for a setpoint held between samples.
+    """
+    a = np.exp(-dt / np.asarray(tau, dtype=float))[..., None]
+    delay = np.exp(-1j * frequencies)
+    return (1 - a) * delay / (1 - a * delay)
+
+
+def simulate(setpoints, tau_bed=TAU_BED, tau_air=TAU_AIR, tau_part=TAU_PART,
+             ambient=AMBIENT, dt=DT):
+    """Run the model over one or many setpoint traces, returning Traces
+
+    setpoints is one trace, a (rows, samples) array or a list of traces of
+    different lengths. The time constants and ambient may be numbers or one
+    value per row, so one schedule can be tried against many boxes or many
+    schedules against one. Everything starts at ambient.
+    """
+    if isinstance(setpoints, (list, tuple)):
+        setpoints, lengths = stack(setpoints, ambient)
+    else:
+        setpoints = np.atleast_2d(np.asarray(setpoints, dtype=float))
+        lengths = None
+    taus = [np.asarray(tau, dtype=float) for tau in (tau_bed, tau_air, tau_part)]
+    ambient = np.asarray(ambient, dtype=float)
+    rows = max([setpoints.shape[0]] + [tau.size for tau in taus] + [ambient.size])
+    setpoints = np.broadcast_to(setpoints, (rows, setpoints.shape[1]))
+    taus = [np.broadcast_to(tau.reshape(-1), (rows,)) if tau.size > 1
+            else np.full(rows, float(tau)) for tau in taus]
+    ambient = np.broadcast_to(ambient.reshape(-1, 1), (rows, 1))
+    if lengths is None:
+        lengths = np.full(rows, setpoints.shape[1])
+    lengths = np.broadcast_to(lengths, (rows,))
+
+    samples = setpoints.shape[1]
+    # Pad well past the slowest response so the circular FFT convolution
+    # does not wrap the end of the cycle back onto the start
+    tail = int(np.ceil(25 * max(float(sum(tau.max() for tau in taus)), dt) / dt))
+    size = 1 << (samples + tail - 1).bit_length()
+    frequencies = 2 * np.pi * np.fft.rfftfreq(size)
+
+    out = [np.empty((rows, samples)) for _ in range(3)]
+    for first in range(0, rows, CHUNK):
+        rows_ = slice(first, first + CHUNK)
+        # Work in degrees above ambient so everything starts from zero
+        spectrum = np.fft.rfft(setpoints[rows_] - ambient[rows_], n=size, axis=1)
+        for trace, tau in zip(out, taus):
+            spectrum = spectrum * lag_response(tau[rows_], dt, frequencies)
+            trace[rows_] = np.fft.irfft(spectrum, n=size, axis=1)[:, :samples] + ambient[rows_]
+    return Traces(dt, lengths, np.array(setpoints), *out)
+
+
+def summary(traces, anneal_temp, band=2):
+    """Per row figures of merit as a dict of arrays
+
+    max_lag      largest setpoint minus part temperature, deg C
+    peak         highest part temperature, deg C
+    soaked       minutes the part spent within band deg C of anneal_temp
+    """
+    running = np.arange(traces.part.shape[1]) < traces.length[:, None]
+    lag = np.where(running, np.abs(traces.setpoint - traces.part), 0)
+    soaked = running & (traces.part >= np.asarray(anneal_temp).reshape(-1, 1) - band)
+    return {
+        'max_lag': lag.max(axis=1),
+        'peak': traces.part.max(axis=1),
+        'soaked': soaked.sum(axis=1) * traces.dt / 60,
+    }
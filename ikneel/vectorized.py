@@ -0,0 +1,133 @@
+"""
+Many programs at once, with the step tables worked out by NumPy.
+
+gcode.iter_anneal walks the schedule a step at a time in Python and fills
+a template per line, which is fine for one program. For tens of
+thousands, tables() works out the setpoint, dwell and countdown of every
+step of every job in a batch as (jobs, steps) arrays, and each program is
+then a single % of one template, the step templates repeated as many
+times as the job has steps, against all its values at once.
+
+Only the version 2.02 output is done this way: Marlin, not compact, not
+exact, no chamber. It comes out byte for byte the same as iter_anneal,
+the countdowns included, which 2.02 got by subtracting the dwell from the
+minutes left a step at a time; np.subtract.accumulate does the same
+float operations in the same order.
+
+NumPy is only needed for this module.
+"""
+
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError('the vectorized generator needs NumPy:  pip install numpy')
+
+from .batch import job_args, job_path
+from .gcode import COOL_START, COOL_STEP, FOOTER, HEADER, HEAT_START, HEAT_STEP, SOAK_STEP, \
+    check_params
+from .writer import Written, open_output
+
+# Jobs worked out together; bounds the (jobs, steps) arrays
+CHUNK = 1024
+
+# (jobs,) arrays of the phase lengths, and (jobs, steps, values) arrays of
+# the template values of each step, in template order. Rows are padded
+# past each job's count.
+Tables = namedtuple('Tables', 'heat_minutes cool_minutes heat_count soak_count cool_count'
+                              ' heat soak cool')
+
+
+def tables(params):
+    """The Tables of a batch, params a (jobs, 5) array of the numbers of job_args"""
+    params = np.asarray(params, dtype=float).reshape(-1, 5)
+    anneal_temp, heat_rate, soak_time, cool_rate, ambient = params.T
+    rows = len(params)
+    span = anneal_temp - ambient
+    heat_minutes = span / heat_rate * 60
+    cool_minutes = span / cool_rate * 60
+    # The heat ramp runs from ambient to anneal_temp inclusive, the cool
+    # ramp from anneal_temp down to one above ambient
+    heat_count = span.astype(np.int64) + 1
+    cool_count = span.astype(np.int64)
+    soak_count = soak_time.astype(np.int64)
+
+    heat_dwell = 3600 / heat_rate
+    steps = np.arange(heat_count.max())
+    left = np.empty((rows, len(steps) + 1))
+    left[:, 0] = heat_minutes
+    left[:, 1:] = (heat_dwell / 60)[:, None]
+    heat = np.empty((rows, len(steps), 3), dtype=np.int64)
+    heat[:, :, 0] = ambient[:, None] + steps
+    heat[:, :, 1] = np.trunc(heat_dwell)[:, None]
+    heat[:, :, 2] = np.trunc(np.subtract.accumulate(left, axis=1)[:, 1:])
+
+    soak = np.empty((rows, soak_count.max(), 2), dtype=np.int64)
+    soak[:, :, 0] = 60
+    soak[:, :, 1] = soak_count[:, None] - 1 - np.arange(soak.shape[1])
+
+    cool_dwell = 3600 / cool_rate
+    steps = np.arange(max(cool_count.max(), 1))
+    left = np.empty((rows, len(steps) + 1))
+    left[:, 0] = cool_minutes
+    left[:, 1:] = np.trunc(cool_dwell / 60)[:, None]
+    cool = np.empty((rows, len(steps), 3), dtype=np.int64)
+    cool[:, :, 0] = anneal_temp[:, None] - steps
+    cool[:, :, 1] = np.trunc(cool_dwell)[:, None]
+    cool[:, :, 2] = np.trunc(np.subtract.accumulate(left, axis=1)[:, 1:])
+    return Tables(heat_minutes, cool_minutes, heat_count, soak_count, cool_count,
+                  heat, soak, cool)
+
+
+@lru_cache(maxsize=4096)
+def repeated(template, count):
+    return template * count
+
+
+def program_template(heat_count, soak_count, cool_count):
+    """The whole program as one template for the given step counts"""
+    return ''.join((HEADER, HEAT_START, repeated(HEAT_STEP, heat_count),
+                    repeated(SOAK_STEP, soak_count), COOL_START,
+                    repeated(COOL_STEP, cool_count), FOOTER))
+
+
+def iter_programs(jobs):
+    """Yield the program of each job, as gcode.generate_anneal would return it
+
+    jobs are job dicts (batch.make_job) and are checked with check_params.
+    """
+    jobs = list(jobs)
+    for start in range(0, len(jobs), CHUNK):
+        chunk = [job_args(job) for job in jobs[start:start + CHUNK]]
+        for args in chunk:
+            check_params(*args[1:])
+        table = tables([args[1:] for args in chunk])
+        heat_minutes = table.heat_minutes.tolist()
+        cool_minutes = table.cool_minutes.tolist()
+        for row, args in enumerate(chunk):
+            material, anneal_temp, heat_rate, soak_time, cool_rate = args[:5]
+            heat_count = int(table.heat_count[row])
+            soak_count = int(table.soak_count[row])
+            cool_count = int(table.cool_count[row])
+            values = np.concatenate((table.heat[row, :heat_count].ravel(),
+                                     table.soak[row, :soak_count].ravel(),
+                                     table.cool[row, :cool_count].ravel())).tolist()
+            heat, cool = heat_minutes[row], cool_minutes[row]
+            yield program_template(heat_count, soak_count, cool_count) % (
+                (material, anneal_temp, heat, heat / 60, heat_rate, soak_time, cool_rate,
+                 cool, cool / 60) + tuple(values))
+
+
+def write_programs(jobs, out_dir='.', compress=False):
+    """Write each job's program like batch.run_batch, yielding (path, writer.Written)"""
+    jobs = list(jobs)
+    if out_dir != '-':
+        os.makedirs(out_dir, exist_ok=True)
+    for job, program in zip(jobs, iter_programs(jobs)):
+        path = job_path(job, out_dir, compress)
+        with open_output(path, compress) as fo:
+            fo.write(program)
+        yield path, Written(1, program.count('\n'), len(program))
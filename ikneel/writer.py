@@ -0,0 +1,135 @@
+"""
+Output side of the generator pipeline.
+
+The generators yield records of whole gcode lines. They are grouped here
+into chunks of about BUFFER_SIZE characters and handed to writelines, so a
+999 minute soak is a handful of writes instead of one per line. Output can
+go to a file, to stdout for piping into an uploader, or through gzip.
+"""
+
+import errno
+import gzip
+import io
+import os
+import sys
+from collections import namedtuple
+from contextlib import contextmanager
+
+from . import metrics
+
+# Characters gathered before each writelines call
+BUFFER_SIZE = 64 * 1024
+
+# What a program cost to write: writelines calls, gcode lines, characters
+Written = namedtuple('Written', 'writes lines size')
+
+
+def chunked(records, size=BUFFER_SIZE):
+    """Group records into lists holding at least size characters"""
+    chunk = []
+    length = 0
+    for record in records:
+        chunk.append(record)
+        length += len(record)
+        if length >= size:
+            yield chunk
+            chunk = []
+            length = 0
+    if chunk:
+        yield chunk
+
+
+def write_records(records, fo, size=BUFFER_SIZE):
+    """Write records to fo in chunks, returning Written"""
+    writes = lines = length = 0
+    recording = metrics.active
+    if recording is None:
+        chunks = ((None, chunk) for chunk in chunked(records, size))
+    else:
+        chunks = recording.chunks(records, size)
+    for phase, chunk in chunks:
+        if recording is None:
+            fo.writelines(chunk)
+        else:
+            recording.write(fo, chunk, phase)
+        writes += 1
+        for record in chunk:
+            lines += record.count('\n')
+            length += len(record)
+    metrics.clock(None)
+    return Written(writes, lines, length)
+
+
+def measure(records):
+    """Count records without writing them, returning Written with writes 0"""
+    lines = length = 0
+    for record in records:
+        lines += record.count('\n')
+        length += len(record)
+    return Written(0, lines, length)
+
+
+@contextmanager
+def open_output(target, compress=False, size=BUFFER_SIZE):
+    """Open target for writing gcode text
+
+    target is a path, or '-' for stdout. compress, or a path ending in .gz,
+    writes gzip. The gzip timestamp is left at 0 so identical programs give
+    identical files.
+
+    A path is written as a temporary file beside it and renamed over it
+    once complete, so a failed write leaves the old file alone and an
+    output hard linked from the cache is replaced rather than written
+    through into the cache. A read only file that is not linked from
+    anywhere is refused with PermissionError, as open() would.
+    """
+    compress = compress or target.endswith('.gz')
+    metrics.clock('file')
+    temp = raw = None
+    if target == '-':
+        sys.stdout.flush()
+        if not compress:
+            yield sys.stdout
+            sys.stdout.flush()
+            return
+        fo = io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb', mtime=0),
+                              write_through=True)
+    else:
+        try:
+            stat = os.stat(target)
+        except FileNotFoundError:
+            pass
+        else:
+            if stat.st_nlink == 1 and not stat.st_mode & 0o200:
+                raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), target)
+        temp = '%s.%d.tmp' % (target, os.getpid())
+        if compress:
+            # The gzip header names the target, not the temporary file
+            raw = open(temp, 'wb')
+            fo = io.TextIOWrapper(gzip.GzipFile(target, 'wb', fileobj=raw, mtime=0),
+                                  write_through=True)
+        else:
+            fo = open(temp, 'w', buffering=size)
+    metrics.clock(None)
+    done = False
+    try:
+        yield fo
+        done = True
+    finally:
+        metrics.clock('file')
+        if target == '-':
+            # Leave stdout itself open for whatever comes next
+            fo.detach().close()
+            sys.stdout.buffer.flush()
+        else:
+            try:
+                fo.close()
+                if raw is not None:
+                    raw.close()
+                if done:
+                    os.replace(temp, target)
+                    temp = None
+            finally:
+                if temp is not None:
+                    os.remove(temp)
+        metrics.clock(None)